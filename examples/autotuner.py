@@ -0,0 +1,161 @@
+import fcntl
+import itertools
+import json
+import logging
+import os
+import time
+from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
+from ctree.tune import TuningDriver
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.path.expanduser("~/.ctree_tuning.json")
+
+
+def expand_space(**params):
+    names = sorted(params)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[params[name] for name in names])]
+
+
+def size_bucket(number_items):
+    return 1 << max(int(number_items) - 1, 0).bit_length()
+
+
+def tuning_key(array_type):
+    number_items = np.prod(array_type._shape_)
+    return "%s/%d" % (array_type._dtype_.str, size_bucket(number_items))
+
+
+class EmpiricalTuningDriver(TuningDriver):
+    def __init__(self, name, candidates, trials=3, db_path=DEFAULT_DB_PATH):
+        self.name = name
+        self.candidates = candidates
+        self.trials = trials
+        self.db_path = db_path
+        self.key = None
+        self._timings = {}
+        self._best = self._load()
+        super(EmpiricalTuningDriver, self).__init__()
+
+    def _get_configs(self):
+        while True:
+            yield self._next_config()
+
+    def _next_config(self):
+        if self.key in self._best:
+            return self._best[self.key]
+        timings = self._timings.setdefault(
+            self.key, [[] for _ in self.candidates])
+        for candidate, times in zip(self.candidates, timings):
+            if len(times) < self.trials:
+                return candidate
+        return self._converge(self.key)
+
+    def converged(self, key):
+        return key in self._best
+
+    def report(self, key=None, config=None, time=None, **kwargs):
+        if self.converged(key) or config not in self.candidates:
+            return
+        timings = self._timings.setdefault(key, [[] for _ in self.candidates])
+        timings[self.candidates.index(config)].append(time)
+        if all(len(times) >= self.trials for times in timings):
+            self._converge(key)
+
+    def _converge(self, key):
+        timings = self._timings.pop(key)
+        best_index = min(range(len(self.candidates)),
+                         key=lambda index: min(timings[index]))
+        best_config = self.candidates[best_index]
+        log.info("autotuner %s converged for %s on %s (%.6fs)",
+                 self.name, key, best_config, min(timings[best_index]))
+        self._best[key] = best_config
+        self._save()
+        return best_config
+
+    def _db_key(self, key):
+        # the host name, without importing socket for it
+        return "%s|%s|%s" % (os.uname()[1], self.name, key)
+
+    def _load(self):
+        if not os.path.exists(self.db_path):
+            return {}
+        with open(self.db_path) as db_file:
+            db = json.load(db_file)
+        prefix = self._db_key("")
+        return {str(db_key[len(prefix):]):
+                dict((str(name), value) for name, value in config.items())
+                for db_key, config in db.items() if db_key.startswith(prefix)}
+
+    def _save(self):
+        # processes tuning at the same time each add their entries to what
+        # the others saved, the lock is held from reading the file to
+        # renaming the new one into place and released when it's closed
+        with open(self.db_path + ".lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            db = {}
+            if os.path.exists(self.db_path):
+                with open(self.db_path) as db_file:
+                    db = json.load(db_file)
+            db.update((self._db_key(key), config)
+                      for key, config in self._best.items())
+            tmp_path = "%s.%d.tmp" % (self.db_path, os.getpid())
+            with open(tmp_path, 'w') as db_file:
+                json.dump(db, db_file, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.db_path)
+
+
+class TimedFunction(ConcreteSpecializedFunction):
+    def __init__(self, function, driver, key, config):
+        self.function = function
+        self.driver = driver
+        self.key = key
+        self.config = config
+
+    def __call__(self, *args, **kwargs):
+        if self.driver.converged(self.key):
+            return self.function(*args, **kwargs)
+        start = time.time()
+        result = self.function(*args, **kwargs)
+        self.driver.report(key=self.key, config=self.config,
+                           time=time.time() - start)
+        return result
+
+
+class AutotunedTranslator(LazySpecializedFunction):
+    tuning_space = [None]
+    tuning_trials = 3
+
+    def get_tuning_driver(self):
+        return EmpiricalTuningDriver(type(self).__name__, self.tuning_space,
+                                     self.tuning_trials)
+
+    def get_tuning_key(self, args_subconfig):
+        return "%s/%s" % (self.sub_dir,
+                          tuning_key(args_subconfig['arg_type']))
+
+    def get_program_config(self, args, kwargs):
+        args_subconfig = self.args_to_subconfig(args)
+        self._tuner.key = self.get_tuning_key(args_subconfig)
+        tuner_subconfig = next(self._tuner.configs)
+        log.info("tuner subconfig: %s", tuner_subconfig)
+        return self.ProgramConfig(args_subconfig, tuner_subconfig)
+
+    def tuning_converged(self, args):
+        # only asked when a call misses the dispatch table of a translator
+        # that has one
+        return self._tuner.converged(
+            self.get_tuning_key(self.args_to_subconfig(args)))
+
+    def finalize(self, transform_result, program_config):
+        function = super(AutotunedTranslator, self).finalize(
+            transform_result, program_config)
+        arg_config, tuner_config = program_config
+        key = self.get_tuning_key(arg_config)
+        # the settled configuration isn't timed anymore, and its function
+        # keeps the size and unload of the kernel for the dispatch table
+        if self._tuner.converged(key):
+            return function
+        return TimedFunction(function, self._tuner, key, tuner_config)
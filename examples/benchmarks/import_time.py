@@ -0,0 +1,59 @@
+import os
+import subprocess
+import sys
+
+# milliseconds each import may take on top of importing ctree itself, which
+# brings in numpy and sets up its configuration and can't be deferred here
+BUDGETS = {
+    'examples.np_functional': 20,
+    'examples.np_functional_inline': 20,
+    'examples.np_functional_tuned': 25,
+    'examples.lazy': 20,
+    'examples.fibonacci_specializer': 15,
+    'priority_queue': 15,
+}
+REPEAT = 9
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+SEARCH_PATH = os.pathsep.join([
+    PACKAGE_PATH, os.path.join(PACKAGE_PATH, "examples"),
+    os.path.join(PACKAGE_PATH, "examples", "priority_queue")])
+
+# ctree is imported first and timed apart, only what the module adds to it
+# is held to the budget
+TIMER = ("import time\n"
+         "start = time.time()\n"
+         "import ctree\n"
+         "middle = time.time()\n"
+         "import %s\n"
+         "print (middle - start) * 1e3, (time.time() - middle) * 1e3\n")
+
+
+def import_time(module):
+    # a new interpreter for every run, the import has to find nothing loaded.
+    # The first run writes the bytecode an installed package would have, so
+    # compiling the sources isn't counted
+    env = dict(os.environ, PYTHONPATH=SEARCH_PATH)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    times = []
+    for _ in range(REPEAT + 1):
+        output = subprocess.check_output(
+            [sys.executable, "-c", TIMER % module], env=env,
+            stderr=open(os.devnull, 'w'))
+        times.append([float(time) for time in output.split()[-2:]])
+    baseline, extra = zip(*times[1:])
+    return min(baseline), min(extra)
+
+
+if __name__ == '__main__':
+    over_budget = []
+    for module in sorted(BUDGETS):
+        baseline, extra = import_time(module)
+        print "%-32s %+6.1fms  (budget %+dms, ctree %.1fms)" % (
+            module, extra, BUDGETS[module], baseline)
+        if extra > BUDGETS[module]:
+            over_budget.append(module)
+    if over_budget:
+        print "over budget: %s" % ", ".join(over_budget)
+        sys.exit(1)
@@ -0,0 +1,52 @@
+import logging
+import timeit
+import numpy as np
+
+from examples.np_functional import BasicTranslator, NpElementwiseTransformer, \
+    np_elementwise
+
+# two 128MB operands, well past the last level cache
+SIZE = 4096
+TILE_SIZES = [0, 16, 32, 64, 128]
+
+
+def add_transposed(a, b):
+    return np_elementwise(lambda x, y: x + y, a, b)
+
+
+def numpy_add(a, b):
+    np.add(a, b, out=a)
+
+
+class TileSizeTranslator(BasicTranslator):
+    def args_to_subconfig(self, args):
+        # a separate kernel on disk for each tile size
+        subconfig = super(TileSizeTranslator, self).args_to_subconfig(args)
+        subconfig['tile_size'] = NpElementwiseTransformer.tile_size
+        return subconfig
+
+
+def specialize(tile_size):
+    # the tile size is read when the kernel is generated on the first call
+    NpElementwiseTransformer.tile_size = tile_size
+    c_add_transposed = TileSizeTranslator.from_function(add_transposed)
+    c_add_transposed(A, B)
+    return c_add_transposed
+
+
+A = np.ones((SIZE, SIZE))
+B = np.ones((SIZE, SIZE)).T
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    print "numpy:"
+    print timeit.repeat('numpy_add(A, B)',
+                        'from __main__ import numpy_add, A, B',
+                        repeat=3, number=1)
+    for tile_size in TILE_SIZES:
+        print "tile_size=%d:" % tile_size
+        print timeit.repeat('c_add_transposed(A, B)',
+                            'from __main__ import specialize, A, B\n'
+                            'c_add_transposed = specialize(%d)' % tile_size,
+                            repeat=3, number=1)
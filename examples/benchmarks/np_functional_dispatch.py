@@ -0,0 +1,44 @@
+import logging
+import timeit
+import numpy as np
+from ctree.jit import LazySpecializedFunction
+
+from examples.np_functional import BasicTranslator, np_map
+
+NUMBER = 2000
+
+
+def double(a):
+    return np_map(lambda x: x * 2, a)
+
+
+c_double = BasicTranslator.from_function(double)
+A = np.ones(16)
+c_double(A)
+KERNEL = c_double.dispatch.get(c_double.get_dispatch_key([A]))
+
+
+def full_lookup():
+    # the lookup every call went through before the dispatch table
+    LazySpecializedFunction.__call__(c_double, A)
+
+
+def dispatch_only():
+    c_double(A)
+
+
+def kernel_only():
+    KERNEL(A)
+
+
+def numpy_only():
+    A * 2
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    for name in ['numpy_only', 'kernel_only', 'dispatch_only', 'full_lookup']:
+        number = NUMBER if name != 'full_lookup' else NUMBER // 20
+        times = timeit.repeat('%s()' % name, 'from __main__ import %s' % name,
+                              repeat=5, number=number)
+        print "%s: %.2fus per call" % (name, min(times) / number * 1e6)
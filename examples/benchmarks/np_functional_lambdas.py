@@ -0,0 +1,61 @@
+import logging
+import timeit
+import numpy as np
+
+from examples.np_functional import BasicTranslator, np_map, np_reduce
+
+SIZE = 1 << 22
+NUMBER = 20
+
+
+class UnoptimizedTranslator(BasicTranslator):
+    optimize_lambdas = False
+
+
+class FastMathTranslator(BasicTranslator):
+    precision = 'fast_math'
+
+
+def map_int(a):
+    return np_map(lambda x: x / 4 + x % 8, a)
+
+
+def map_float(a):
+    return np_map(lambda x: x / 3.0 + 1.5, a)
+
+
+def map_shared(a):
+    return np_map(lambda x: (x * x + 1) * (x * x + 1), a)
+
+
+def reduce_int(a):
+    return np_reduce(lambda x, y: x + y % 16, a)
+
+
+def reduce_float(a):
+    return np_reduce(lambda x, y: x + y / 3.0, a)
+
+
+KERNELS = [(map_int, np.int64), (map_float, np.float64),
+           (map_shared, np.float64), (reduce_int, np.int64),
+           (reduce_float, np.float64)]
+VARIANTS = [('off', UnoptimizedTranslator), ('on', BasicTranslator),
+            ('fast math', FastMathTranslator)]
+
+
+def time_kernel(translator, function, dtype):
+    # the maps run in place, the values change from one call to the next
+    # but not the work
+    array = np.arange(SIZE, dtype=dtype) % 1000 + 1
+    kernel = translator.from_function(function).specialize([array])
+    return min(timeit.repeat(lambda: kernel(array), repeat=5,
+                             number=NUMBER)) / NUMBER
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    print "%-14s" % "kernel" + "".join("%12s" % name for name, _ in VARIANTS)
+    for function, dtype in KERNELS:
+        print "%-14s" % function.__name__ + "".join(
+            "%10.2fms" % (time_kernel(translator, function, dtype) * 1e3)
+            for _, translator in VARIANTS)
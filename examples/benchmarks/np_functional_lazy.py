@@ -0,0 +1,62 @@
+import logging
+import timeit
+import numpy as np
+
+from examples.np_functional import BasicTranslator, np_map, np_reduce, \
+    np_elementwise
+from examples.lazy import LazyTranslator
+
+SIZES = [1 << 10, 1 << 16, 1 << 22]
+NUMBER = 20
+
+
+def scale(a):
+    return np_map(lambda x: x * 2.0 + 1.0, a)
+
+
+def product(a, b):
+    return np_elementwise(lambda x, y: x * y, a, b)
+
+
+def total(a):
+    return np_reduce(lambda x, y: x + y, a)
+
+
+def pipeline(translator):
+    scale_kernel, product_kernel, total_kernel = [
+        translator.from_function(function, "%s_%s" % (
+            translator.__name__, function.__name__))
+        for function in (scale, product, total)]
+
+    def run(a, b):
+        return float(total_kernel(product_kernel(scale_kernel(a), b)))
+    return run
+
+
+def eager_pipeline():
+    # the kernels called one at a time write into their first array, every
+    # run starts from a copy of the input for the same result
+    run = pipeline(BasicTranslator)
+    copies = {}
+
+    def run_copy(a, b):
+        copy = copies.setdefault(a.shape, np.empty_like(a))
+        np.copyto(copy, a)
+        return run(copy, b)
+    return run_copy
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    eager, lazy = eager_pipeline(), pipeline(LazyTranslator)
+    print "%10s %12s %12s %8s" % ("size", "eager", "lazy", "speedup")
+    for size in SIZES:
+        a = np.random.RandomState(0).rand(size)
+        b = np.random.RandomState(1).rand(size)
+        if not np.allclose(eager(a, b), lazy(a, b)):
+            raise Exception("lazy result differs for size %d" % size)
+        times = [min(timeit.repeat(lambda: run(a, b), repeat=5,
+                                   number=NUMBER)) / NUMBER
+                 for run in (eager, lazy)]
+        print "%10d %10.3fms %10.3fms %7.2fx" % (
+            size, times[0] * 1e3, times[1] * 1e3, times[0] / times[1])
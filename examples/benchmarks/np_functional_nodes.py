@@ -0,0 +1,64 @@
+import ast
+import logging
+import resource
+import subprocess
+import sys
+import timeit
+import numpy as np
+from ctree.c.nodes import CFile, SymbolRef, Constant
+from ctree.transformations import PyBasicConversions
+from ctree.transforms import DeclarationFiller
+
+from examples import np_functional
+from examples.np_functional import NpFunctionalTransformer
+from examples.type_inference import TypeInference
+
+MODULE = "examples.benchmarks.np_functional_nodes"
+NUMBER_CALLS = 200
+ARRAY_TYPE = np.ctypeslib.ndpointer(np.float64, 2, (32, 32))
+
+SOURCE = "def apply(a):\n    b = 0\n" + "".join(
+    "    np_map(lambda x: x*%d + 1, a)\n"
+    "    np_elementwise(lambda x, y: x+y, a, a)\n"
+    "    b = b + np_reduce(lambda x, y: x+y, np_map(lambda x: x/%d, a))\n"
+    % (i + 1, i + 1) for i in range(NUMBER_CALLS)) + "    return b\n"
+
+
+def transform():
+    tree = NpFunctionalTransformer(ARRAY_TYPE).visit(ast.parse(SOURCE))
+    tree = PyBasicConversions().visit(tree)
+    c_file = CFile("generated", [NpFunctionalTransformer.lifted_functions(),
+                                 tree])
+    c_file = DeclarationFiller().visit(TypeInference([ARRAY_TYPE()]).visit(
+        c_file))
+    c_file.codegen()
+    return c_file
+
+
+def run(variant):
+    if variant == 'fresh':
+        # a new node for every use, as before the nodes were shared
+        np_functional.symbol = SymbolRef
+        np_functional.constant = Constant
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    c_file = transform()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del c_file
+    del NpFunctionalTransformer.lifted_functions()[:]
+    times = timeit.repeat(
+        'transform()\ndel NpFunctionalTransformer.lifted_functions()[:]',
+        'from __main__ import transform, NpFunctionalTransformer',
+        repeat=3, number=1)
+    print "%s: peak memory +%.1fMB, times %s" % (variant,
+                                                (peak - before) / 1024.0,
+                                                times)
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+    else:
+        # a process per variant so that each starts from the same peak
+        for variant in ['fresh', 'shared']:
+            subprocess.check_call([sys.executable, "-m", MODULE, variant])
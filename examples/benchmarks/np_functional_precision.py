@@ -0,0 +1,70 @@
+import logging
+import math
+import timeit
+import numpy as np
+
+from examples.np_functional import BasicTranslator, np_reduce
+
+SIZE = 1 << 22
+NUMBER = 20
+
+
+class ReassociateTranslator(BasicTranslator):
+    precision = 'reassociate'
+
+
+class FastMathTranslator(BasicTranslator):
+    precision = 'fast_math'
+
+
+def sum_all(a):
+    return np_reduce(lambda x, y: x + y, a)
+
+
+def max_all(a):
+    return np_reduce(lambda x, y: x if x > y else y, a)
+
+
+def sum_rows(a):
+    return np_reduce(lambda x, y: x + y, a, axis=1)
+
+
+KERNELS = [(sum_all, (SIZE,), np.float64), (sum_all, (SIZE,), np.float32),
+           (max_all, (SIZE,), np.float64),
+           (sum_rows, (SIZE >> 10, 1 << 10), np.float64)]
+VARIANTS = [('strict', BasicTranslator),
+            ('reassociate', ReassociateTranslator),
+            ('fast math', FastMathTranslator)]
+
+
+def time_kernel(translator, function, array):
+    kernel = translator.from_function(function).specialize([array])
+    result = kernel(array)
+    seconds = min(timeit.repeat(lambda: kernel(array), repeat=5,
+                                number=NUMBER)) / NUMBER
+    return seconds, result
+
+
+def relative_error(result, array):
+    # against the correctly rounded sum of the first row
+    row = array.reshape(-1, array.shape[-1])[0] if array.ndim > 1 else array
+    exact = math.fsum(row.astype(np.float64))
+    value = result[0] if array.ndim > 1 else result
+    return abs(value - exact) / abs(exact)
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    print "%-18s" % "kernel" + "".join("%22s" % name for name, _ in VARIANTS)
+    for function, shape, dtype in KERNELS:
+        array = np.random.RandomState(0).rand(*shape).astype(dtype)
+        row = []
+        for _, translator in VARIANTS:
+            seconds, result = time_kernel(translator, function, array)
+            if function is max_all:
+                row.append("%10.2fms" % (seconds * 1e3) + " " * 12)
+            else:
+                row.append("%10.2fms  err %.0e" % (
+                    seconds * 1e3, relative_error(result, array)))
+        print "%-18s" % ("%s %s" % (function.__name__,
+                                    np.dtype(dtype).name)) + "".join(row)
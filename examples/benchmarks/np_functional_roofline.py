@@ -0,0 +1,41 @@
+import logging
+import numpy as np
+
+from examples.np_functional import BasicTranslator, np_map, np_reduce, \
+    np_elementwise
+from examples.kernel_stats import format_roofline, measure_peaks, roofline
+
+SIZES = [1 << 10, 1 << 22]
+NUMBER = 20
+
+
+class InstrumentedTranslator(BasicTranslator):
+    instrument = True
+
+
+def axpy(a, b):
+    return np_elementwise(lambda x, y: 2.5 * x + y, a, b)
+
+
+def polynomial(a, b):
+    return np_map(lambda x: ((x * 0.5 + 1.0) * x + 2.0) * x + 3.0, a)
+
+
+def total(a, b):
+    return np_reduce(lambda x, y: x + y, a)
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    bandwidth, gflops = measure_peaks()
+    print "numpy reaches %.1f GB/s and %.1f GFLOP/s here\n" % (bandwidth,
+                                                              gflops)
+    rows = []
+    for function in [axpy, polynomial, total]:
+        translator = InstrumentedTranslator.from_function(function)
+        for size in SIZES:
+            a, b = np.ones(size), np.ones(size)
+            for _ in range(NUMBER):
+                translator(a, b)
+        rows.extend(roofline(translator, bandwidth, gflops))
+    print format_roofline(rows)
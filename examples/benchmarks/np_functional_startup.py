@@ -0,0 +1,49 @@
+import logging
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+
+from examples import transform_cache
+from examples.np_functional import BasicTranslator, np_map, np_reduce, \
+    np_elementwise, np_scan
+
+MODULE = "examples.benchmarks.np_functional_startup"
+
+
+def kernels(a, b):
+    np_map(lambda x: x * 3 + 1, a)
+    np_elementwise(lambda x, y: x * y - 2, a, b)
+    np_scan(lambda x, y: x + y, b)
+    return np_reduce(lambda x, y: x + y, np_map(lambda x: x / 2, a))
+
+
+def aligned_ones(shape):
+    # the alignment is part of the configuration, the same one in every
+    # process keeps the runs comparable
+    buffer = np.empty(int(np.prod(shape)) + 8)
+    start = (-buffer.ctypes.data % 64) // buffer.itemsize
+    array = buffer[start:start + int(np.prod(shape))].reshape(shape)
+    array[...] = 1
+    return array
+
+
+def run(variant):
+    # in a new process, the shared object is built already either way
+    start = time.time()
+    c_kernels = BasicTranslator.from_function(kernels)
+    c_kernels.specialize([aligned_ones((64, 64)), aligned_ones((64, 64))])
+    print "%s: %.1fms" % (variant, (time.time() - start) * 1e3)
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+    else:
+        # the first run builds the shared object the others load
+        for variant in ['build'] + ['cold', 'warm'] * 3:
+            if variant != 'warm':
+                shutil.rmtree(transform_cache.CACHE_PATH, ignore_errors=True)
+            subprocess.check_call([sys.executable, "-m", MODULE, variant])
@@ -0,0 +1,44 @@
+import ast
+import copy
+import timeit
+import numpy as np
+
+from examples.np_functional import NpFunctionalTransformer
+
+NUMBER_CALLS = 50
+# plain scalar code between the operator calls, which every extra pass walks
+NUMBER_STATEMENTS = 20
+ARRAY_TYPE = np.ctypeslib.ndpointer(np.int64, 1, (1024,))
+
+SOURCE = "def apply(a):\n    b = 0\n" + "".join(
+    "    np_map(lambda x: x*%d, a)\n"
+    "    np_elementwise(lambda x, y: x+y, a, a)\n"
+    "    b = np_reduce(lambda x, y: x+y, np_map(lambda x: x/%d, a))\n"
+    % (i + 1, i + 1) +
+    "    b = (b * 3 + a[1] - a[2]) % 7 if b > a[0] else b + 1\n"
+    * NUMBER_STATEMENTS for i in range(NUMBER_CALLS)) + "    return b\n"
+TREE = ast.parse(SOURCE)
+
+
+def one_pass_per_operator():
+    tree = copy.deepcopy(TREE)
+    for transformer in NpFunctionalTransformer.transformers:
+        transformer(ARRAY_TYPE).visit(tree)
+    del NpFunctionalTransformer.lifted_functions()[:]
+
+
+def single_pass():
+    tree = copy.deepcopy(TREE)
+    NpFunctionalTransformer(ARRAY_TYPE).visit(tree)
+    del NpFunctionalTransformer.lifted_functions()[:]
+
+
+def deepcopy_only():
+    copy.deepcopy(TREE)
+
+
+if __name__ == '__main__':
+    for name in ['deepcopy_only', 'one_pass_per_operator', 'single_pass']:
+        print "%s:" % name
+        print timeit.repeat('%s()' % name, 'from __main__ import %s' % name,
+                            repeat=5, number=1)
@@ -0,0 +1,44 @@
+import os
+import timeit
+from ctree.c.nodes import SymbolRef, Constant
+from ctree.templates.nodes import FileTemplate, StringTemplate
+
+from examples.template_cache import cached_file_template, \
+    cached_string_template, TEMPLATE_CACHE
+from examples.self_recursion import MEMO_TEMPLATE
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "np_map.tmpl.c")
+CHILDREN = {'NUMBER_ITEMS': Constant(2000),
+            'INNER_FUNCTION': SymbolRef("LAMBDA_0")}
+CASES = [("np_map.tmpl.c", TEMPLATE_PATH, CHILDREN,
+          [FileTemplate, cached_file_template]),
+         ("MEMO_TEMPLATE", MEMO_TEMPLATE, {},
+          [StringTemplate, cached_string_template])]
+REPEAT = 7
+NUMBER = 10000
+
+
+def per_node(statement):
+    # the best of the runs, in microseconds for one node
+    return min(timeit.repeat(statement, repeat=REPEAT, number=NUMBER)) / \
+        NUMBER * 1e6
+
+
+if __name__ == '__main__':
+    print "%-16s %-24s %10s %10s" % ("template", "node", "create",
+                                     "codegen")
+    for name, source, children, factories in CASES:
+        codes = set()
+        for factory in factories:
+            template = factory(source, children)
+            codes.add(template.codegen(indent=1))
+            print "%-16s %-24s %8.1fus %8.1fus" % (
+                name, factory.__name__,
+                per_node(lambda: factory(source, children)),
+                per_node(lambda: template.codegen(indent=1)))
+        # the cache only saves reading and parsing, the code is the same
+        if len(codes) != 1:
+            raise Exception("cached %s generates different code" % name)
+    print "template cache hits: %d, misses: %d" % (TEMPLATE_CACHE.hits,
+                                                   TEMPLATE_CACHE.misses)
@@ -0,0 +1,31 @@
+import os
+import stat
+import tempfile
+
+# the caches that outlive a process hold code the next ones load, so each
+# user gets a directory no one else can write to
+CACHE_ROOT = os.path.join(tempfile.gettempdir(), "ctree-%d" % os.getuid())
+
+
+def makedirs(path, mode=0777):
+    # processes building or specializing the same thing race to create the
+    # same directories, the one that loses finds them there
+    try:
+        os.makedirs(path, mode)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def cache_dir(path):
+    # a directory under CACHE_ROOT, checked before anything is loaded from
+    # it. one made in advance by someone else, or left open to others, could
+    # hand us their code
+    makedirs(CACHE_ROOT, 0700)
+    status = os.lstat(CACHE_ROOT)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or \
+            status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise Exception("%s must be a directory of user %d that only it can "
+                        "write to" % (CACHE_ROOT, os.getuid()))
+    return makedirs(path, 0700)
@@ -1,4 +1,6 @@
 import ctypes
+import os
+import sys
 from ctree.types import get_ctype
 from ctree.nodes import Project
 from ctree.c.nodes import FunctionDecl, CFile
@@ -8,6 +10,10 @@ from ctree.jit import ConcreteSpecializedFunction
 
 import timeit
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, os.pardir))
+from self_recursion import SelfRecursionOptimizer
+
 
 def fib(n):
     if n < 2:
@@ -17,6 +23,7 @@ def fib(n):
 
 
 class BasicTranslator(LazySpecializedFunction):
+    recursion_strategy = None
 
     def args_to_subconfig(self, args):
         return {'arg_type': type(get_ctype(args[0]))}
@@ -28,6 +35,8 @@ class BasicTranslator(LazySpecializedFunction):
         arg_type = program_config.args_subconfig['arg_type']
         fib_fn.return_type = arg_type()
         fib_fn.params[0].type = arg_type()
+        if self.recursion_strategy is not None:
+            tree = SelfRecursionOptimizer(self.recursion_strategy).visit(tree)
         c_translator = CFile("generated", [tree])
 
         return [c_translator]
@@ -42,6 +51,14 @@ class BasicTranslator(LazySpecializedFunction):
         return BasicFunction("apply", proj, entry_type)
 
 
+class MemoTranslator(BasicTranslator):
+    recursion_strategy = "memo"
+
+
+class IterativeTranslator(BasicTranslator):
+    recursion_strategy = "iterative"
+
+
 class BasicFunction(ConcreteSpecializedFunction):
     def __init__(self, entry_name, project_node, entry_typesig):
         self._c_function = self._compile(entry_name, project_node,
@@ -51,6 +68,16 @@ class BasicFunction(ConcreteSpecializedFunction):
         return self._c_function(*args, **kwargs)
 
 c_fib = BasicTranslator.from_function(fib)
+c_fib_memo = MemoTranslator.from_function(fib)
+c_fib_iterative = IterativeTranslator.from_function(fib)
 
+print "faithful:"
 print timeit.repeat('c_fib(40)', 'from __main__ import c_fib', repeat=20,
                     number=1)
+print "memo:"
+print timeit.repeat('c_fib_memo(40)', 'from __main__ import c_fib_memo',
+                    repeat=20, number=1)
+print "iterative:"
+print timeit.repeat('c_fib_iterative(40)',
+                    'from __main__ import c_fib_iterative', repeat=20,
+                    number=1)
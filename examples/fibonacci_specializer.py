@@ -50,7 +50,9 @@ class BasicFunction(ConcreteSpecializedFunction):
     def __call__(self, *args, **kwargs):
         return self._c_function(*args, **kwargs)
 
-c_fib = BasicTranslator.from_function(fib)
 
-print c_fib(10), fib(10)
-print c_fib(4.5), fib(4.5)
+if __name__ == '__main__':
+    c_fib = BasicTranslator.from_function(fib)
+
+    print c_fib(10), fib(10)
+    print c_fib(4.5), fib(4.5)
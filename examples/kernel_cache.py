@@ -0,0 +1,100 @@
+from _ctypes import dlclose
+from ctypes import CDLL
+import itertools
+import logging
+import sys
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class SharedLibrary(CDLL):
+    # closed once nothing refers to it anymore. The functions taken from it
+    # with lib[name] refer to it, unlike getattr(lib, name) they aren't kept
+    # by the library, which would make a cycle that's never collected
+    def __del__(self):
+        dlclose(self._handle)
+
+
+class KernelCache(object):
+    # least recently used concrete functions beyond max_kernels, or beyond
+    # max_bytes of shared objects, are evicted and their libraries unloaded
+    def __init__(self, max_kernels=256, max_bytes=256 << 20):
+        self.max_kernels = max_kernels
+        self.max_bytes = max_bytes
+        # key -> [function, size in bytes, last use]
+        self.entries = {}
+        self.nbytes = 0
+        self.retired = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.unloads = 0
+        self._ticks = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        # only a dict lookup and a store on a hit, the order is worked out
+        # when something has to go. Under the lock, an eviction can't take
+        # the entry away halfway and the counters don't lose updates
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry[2] = next(self._ticks)
+            return entry[0]
+
+    def put(self, key, function):
+        size = getattr(function, 'nbytes', 0)
+        with self._lock:
+            if key in self.entries:
+                self.nbytes -= self.entries[key][1]
+            self.entries[key] = [function, size, next(self._ticks)]
+            self.nbytes += size
+            while len(self.entries) > 1 and (
+                    len(self.entries) > self.max_kernels or
+                    self.nbytes > self.max_bytes):
+                self._evict(min(self.entries,
+                                key=lambda k: self.entries[k][2]))
+            self._unload_retired()
+        return function
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.entries):
+                self._evict(key)
+            self._unload_retired()
+
+    def _evict(self, key):
+        function, size, _ = self.entries.pop(key)
+        self.nbytes -= size
+        self.evictions += 1
+        self.retired.append(function)
+
+    def _unload_retired(self):
+        # a thread that got a function before it was evicted may still be
+        # calling it, its library is only closed once nothing else refers to
+        # the function
+        retired, self.retired = self.retired, []
+        while retired:
+            function = retired.pop()
+            # the references of this frame and of getrefcount's argument
+            if sys.getrefcount(function) > 2:
+                self.retired.append(function)
+            elif hasattr(function, 'unload'):
+                function.unload()
+                self.unloads += 1
+        if self.retired:
+            log.debug("%d evicted kernels still in use", len(self.retired))
+
+    @property
+    def metrics(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'unloads': self.unloads,
+                'kernels': len(self.entries), 'bytes': self.nbytes,
+                'retired': len(self.retired)}
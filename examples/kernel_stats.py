@@ -0,0 +1,73 @@
+import timeit
+import numpy as np
+
+# what one kernel call costs beyond its work shows up as a low efficiency,
+# below this fraction of its roof a kernel is flagged
+ANOMALY_FRACTION = 0.2
+
+
+def measure_peaks():
+    # what numpy gets out of this machine, streaming arrays too large for
+    # the caches for the bandwidth and a matrix product in them for the
+    # arithmetic. the kernels can beat it, numpy isn't the roof itself
+    source = np.ones(1 << 24)
+    target = np.empty_like(source)
+    bandwidth = 0.0
+    for streamed, run in [(2, lambda: np.copyto(target, source)),
+                          (2, lambda: np.multiply(target, 2.0, out=target)),
+                          (1, lambda: source.sum())]:
+        seconds = min(timeit.repeat(run, repeat=5, number=1))
+        bandwidth = max(bandwidth, streamed * source.nbytes / seconds * 1e-9)
+    matrix = np.ones((256, 256))
+    seconds = min(timeit.repeat(lambda: matrix.dot(matrix), repeat=5,
+                                number=10)) / 10
+    gflops = 2 * matrix.shape[0] ** 3 / seconds * 1e-9
+    return bandwidth, gflops
+
+
+def describe_arguments(function):
+    return ", ".join(
+        "%s%s" % (argtype._dtype_, list(argtype._shape_))
+        if hasattr(argtype, '_dtype_') else argtype.__name__
+        for argtype in function._c_function.argtypes)
+
+
+def roofline(translator, peak_bandwidth=None, peak_gflops=None,
+             anomaly_fraction=ANOMALY_FRACTION):
+    # every kernel of the translator's instrumented specializations that
+    # has run, against the lower of the bandwidth and arithmetic roofs
+    if peak_bandwidth is None or peak_gflops is None:
+        measured_bandwidth, measured_gflops = measure_peaks()
+        peak_bandwidth = peak_bandwidth or measured_bandwidth
+        peak_gflops = peak_gflops or measured_gflops
+    rows = []
+    for function, _, _ in translator.dispatch.entries.values():
+        for stats in function.kernel_stats():
+            if not stats['calls'] or not stats['seconds']:
+                continue
+            intensity = float(stats['operations']) / stats['bytes'] \
+                if stats['bytes'] else float('inf')
+            if intensity * peak_bandwidth < peak_gflops:
+                bound = 'memory'
+                efficiency = stats['gbytes_per_second'] / peak_bandwidth
+            else:
+                bound = 'compute'
+                efficiency = stats['gflops'] / peak_gflops
+            rows.append(dict(
+                stats, specialization=describe_arguments(function),
+                intensity=intensity, bound=bound, efficiency=efficiency,
+                anomaly=efficiency < anomaly_fraction))
+    return sorted(rows, key=lambda row: row['seconds'], reverse=True)
+
+
+def format_roofline(rows):
+    lines = ["%-18s %-36s %6s %9s %7s %7s %7s %7s" % (
+        "kernel", "arguments", "calls", "us/call", "GB/s", "GFLOP/s",
+        "bound", "of roof")]
+    for row in rows:
+        lines.append("%-18s %-36s %6d %9.1f %7.2f %7.2f %7s %6.0f%%%s" % (
+            row['kernel'], row['specialization'][:36], row['calls'],
+            row['seconds'] / row['calls'] * 1e6, row['gbytes_per_second'],
+            row['gflops'], row['bound'], row['efficiency'] * 100,
+            "  <- anomaly" if row['anomaly'] else ""))
+    return "\n".join(lines)
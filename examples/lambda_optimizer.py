@@ -0,0 +1,293 @@
+import ast
+import math
+import operator
+from ctree.c.nodes import BinaryOp, CNode, Constant, FunctionCall, Op, \
+    SymbolRef, TernaryOp, UnaryOp
+from ctree.visitors import NodeTransformer
+
+# calls whose result only depends on their arguments, repeated ones can be
+# made once
+PURE_FUNCTIONS = frozenset(
+    name + suffix for name in ["sqrt", "exp", "log", "sin", "cos", "tan",
+                               "pow", "fabs", "floor", "ceil"]
+    for suffix in ["", "f"])
+
+ARITHMETIC_OPS = (Op.Add, Op.Sub, Op.Mul, Op.Div, Op.Mod)
+PURE_OPS = ARITHMETIC_OPS + (Op.BitShL, Op.BitShR, Op.BitAnd, Op.BitOr,
+                             Op.BitXor, Op.Gt, Op.Lt, Op.GtE, Op.LtE, Op.Eq,
+                             Op.NotEq)
+# the right side of these is only evaluated depending on the left one
+SHORT_CIRCUIT_OPS = (Op.And, Op.Or)
+ASSOCIATIVE_OPS = (Op.Add, Op.Mul, Op.BitAnd, Op.BitOr, Op.BitXor)
+PURE_UNARY_OPS = (Op.SubUnary, Op.AddUnary, Op.Not, Op.BitNot)
+
+LONG_MIN, LONG_MAX = -1 << 63, (1 << 63) - 1
+
+
+class ExactFloat(float):
+    # ctree prints constants with str(), which keeps 12 digits
+    def __str__(self):
+        return repr(float(self))
+
+
+class SharedExpression(CNode):
+    # a GNU statement expression, each value is computed once into its name
+    # and the result can refer to them
+    _fields = ['values', 'result']
+
+    def __init__(self, names, values, result):
+        self.names = names
+        self.values = values
+        self.result = result
+        super(SharedExpression, self).__init__()
+
+    def codegen(self, indent=0):
+        # on one line, it ends up in a macro
+        return "({ %s%s; })" % ("".join(
+            "__typeof__(%s) %s = %s; " % (value, name, value)
+            for name, value in zip(self.names, self.values)), self.result)
+
+
+def is_integer(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def c_div(left, right):
+    # integers divide like C, rounding towards zero, as the kernels built
+    # without the optimizer do
+    if not (is_integer(left) and is_integer(right)):
+        return operator.div(left, right)
+    quotient = abs(left) // abs(right)
+    return quotient if (left < 0) == (right < 0) else -quotient
+
+
+def c_mod(left, right):
+    # the sign of the left side, so that (a / b) * b + a % b == a
+    return left - right * c_div(left, right)
+
+
+FOLDERS = {Op.Add: operator.add, Op.Sub: operator.sub,
+           Op.Mul: operator.mul, Op.Div: c_div, Op.Mod: c_mod}
+
+
+def exact_constant(value):
+    # folded values that can't be written as a C literal stay unfolded
+    if is_integer(value):
+        return Constant(value) if LONG_MIN <= value <= LONG_MAX else None
+    if isinstance(value, float):
+        if math.isinf(value) or math.isnan(value):
+            return None
+        return Constant(ExactFloat(value))
+    return None
+
+
+def fold(op, left, right):
+    folder = FOLDERS.get(type(op))
+    if folder is None or not all(is_integer(value) or
+                                 isinstance(value, float)
+                                 for value in (left, right)):
+        return None
+    if isinstance(op, (Op.Div, Op.Mod)) and right == 0:
+        return None
+    # C has no % for floating point
+    if isinstance(op, Op.Mod) and not (is_integer(left) and
+                                       is_integer(right)):
+        return None
+    return exact_constant(folder(left, right))
+
+
+def is_pure(node):
+    if isinstance(node, (SymbolRef, Constant)):
+        return True
+    if isinstance(node, BinaryOp):
+        return isinstance(node.op, PURE_OPS + SHORT_CIRCUIT_OPS) and \
+            is_pure(node.left) and is_pure(node.right)
+    if isinstance(node, UnaryOp):
+        return isinstance(node.op, PURE_UNARY_OPS) and is_pure(node.arg)
+    if isinstance(node, TernaryOp):
+        return all(is_pure(child)
+                   for child in (node.cond, node.then, node.elze))
+    if isinstance(node, FunctionCall):
+        return getattr(node.func, 'name', None) in PURE_FUNCTIONS and \
+            all(is_pure(arg) for arg in node.args)
+    return False
+
+
+def count_operations(body):
+    # the arithmetic and comparisons of one application, a call to a math
+    # function counts as one
+    return sum(1 for node in ast.walk(body)
+               if isinstance(node, BinaryOp) and
+               isinstance(node.op, PURE_OPS) or
+               isinstance(node, FunctionCall) and
+               getattr(node.func, 'name', None) in PURE_FUNCTIONS)
+
+
+def always_evaluated(node):
+    # the subexpressions a shared value can be taken from without computing
+    # something the expression might have skipped, like a division by zero
+    yield node
+    if isinstance(node, TernaryOp):
+        children = [node.cond]
+    elif isinstance(node, BinaryOp):
+        children = [node.left] if isinstance(node.op, SHORT_CIRCUIT_OPS) \
+            else [node.left, node.right]
+    elif isinstance(node, UnaryOp):
+        children = [node.arg]
+    elif isinstance(node, FunctionCall):
+        children = node.args
+    else:
+        children = []
+    for child in children:
+        for subexpression in always_evaluated(child):
+            yield subexpression
+
+
+def is_associative(params, body):
+    # a body combining its two parameters in an order that doesn't matter,
+    # like a + b or a if a > b else b, can be reduced in several lanes
+    names = set(param.name for param in params)
+    if len(names) != 2:
+        return False
+
+    def is_pair(left, right):
+        return isinstance(left, SymbolRef) and isinstance(right, SymbolRef) \
+            and set([left.name, right.name]) == names
+
+    if isinstance(body, BinaryOp):
+        return isinstance(body.op, ASSOCIATIVE_OPS) and \
+            is_pair(body.left, body.right)
+    if isinstance(body, TernaryOp):
+        # a minimum or a maximum
+        return isinstance(body.cond, BinaryOp) and \
+            isinstance(body.cond.op, (Op.Gt, Op.Lt, Op.GtE, Op.LtE)) and \
+            is_pair(body.cond.left, body.cond.right) and \
+            is_pair(body.then, body.elze)
+    return False
+
+
+class SubexpressionReplacer(NodeTransformer):
+    def __init__(self, code, name):
+        self.code = code
+        self.name = name
+
+    def visit(self, node):
+        if isinstance(node, CNode) and str(node) == self.code:
+            return SymbolRef(self.name)
+        return super(SubexpressionReplacer, self).visit(node)
+
+
+class LambdaOptimizer(NodeTransformer):
+    # simplifies the body of a lifted lambda before it becomes a macro:
+    # constants are folded, divisions reduced and repeated subexpressions
+    # computed once. param_kinds maps the parameter names to 'i' or 'f' for
+    # integer or floating point elements, when all the arrays agree, and
+    # precision is the translator's floating point policy
+    def __init__(self, param_kinds=None, precision='strict'):
+        self.param_kinds = param_kinds or {}
+        self.precision = precision
+
+    def optimize(self, body, prefix):
+        return self.share_subexpressions(self.visit(body), prefix)
+
+    def kind(self, node):
+        if isinstance(node, Constant):
+            if is_integer(node.value):
+                return 'i'
+            return 'f' if isinstance(node.value, float) else None
+        if isinstance(node, SymbolRef):
+            return self.param_kinds.get(node.name)
+        if isinstance(node, UnaryOp) and \
+                isinstance(node.op, (Op.SubUnary, Op.AddUnary)):
+            return self.kind(node.arg)
+        if isinstance(node, BinaryOp) and \
+                isinstance(node.op, ARITHMETIC_OPS):
+            kinds = set([self.kind(node.left), self.kind(node.right)])
+            if kinds == set(['i']):
+                return 'i'
+            if None not in kinds:
+                return 'f'
+        return None
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, Op.SubUnary) and \
+                isinstance(node.arg, Constant):
+            return exact_constant(-node.arg.value) or node
+        return node
+
+    def visit_BinaryOp(self, node):
+        self.generic_visit(node)
+        left, op, right = node.left, node.op, node.right
+        if isinstance(left, Constant) and isinstance(right, Constant):
+            return fold(op, left.value, right.value) or node
+        if isinstance(right, Constant):
+            return self.simplify(node, left, op, right.value)
+        if isinstance(left, Constant) and isinstance(op, (Op.Add, Op.Mul)):
+            # constants go right, where simplify looks for them
+            return self.simplify(BinaryOp(right, op, left), right, op,
+                                 left.value)
+        return node
+
+    def simplify(self, node, left, op, value):
+        integer = self.kind(left) == 'i'
+        if isinstance(op, (Op.Mul, Op.Div)) and is_integer(value) and \
+                value == 1 and self.kind(left) is not None:
+            return left
+        if isinstance(op, (Op.Add, Op.Sub)) and is_integer(value) and \
+                value == 0 and integer:
+            return left
+        # (x + 1) + 2 is x + 3, which only holds for floating point when
+        # reassociating is allowed
+        if isinstance(op, (Op.Add, Op.Mul)) and \
+                isinstance(left, BinaryOp) and type(left.op) is type(op) and \
+                isinstance(left.right, Constant) and (
+                    integer and is_integer(left.right.value) and
+                    is_integer(value) or
+                    self.kind(left) == 'f' and self.precision != 'strict'):
+            folded = fold(op, left.right.value, value)
+            if folded is not None:
+                return self.simplify(BinaryOp(left.left, op, folded),
+                                     left.left, op, folded.value)
+        # integer division and modulo are left to the compiler, which turns
+        # a power of two into a shift with the bias C's rounding towards
+        # zero needs
+        if isinstance(op, Op.Div) and self.kind(left) == 'f' and value:
+            # the reciprocal of a power of two is exact, of anything else it
+            # is rounded and only used with fast math
+            mantissa, _ = math.frexp(value)
+            if abs(mantissa) == 0.5 or self.precision == 'fast_math':
+                reciprocal = exact_constant(1.0 / value)
+                if reciprocal is not None:
+                    return BinaryOp(left, Op.Mul(), reciprocal)
+        return node
+
+    def share_subexpressions(self, body, prefix):
+        names, values = [], []
+        while True:
+            counts = {}
+            for root in [body] + values:
+                for subexpression in always_evaluated(root):
+                    if isinstance(subexpression, (BinaryOp, FunctionCall,
+                                                  TernaryOp)) and \
+                            is_pure(subexpression):
+                        code = str(subexpression)
+                        counts[code] = counts.get(code, 0) + 1
+            repeated = [code for code, count in counts.items() if count > 1]
+            if not repeated:
+                break
+            # the largest first, the ones inside it are counted again after
+            code = max(repeated, key=len)
+            name = "_%s_%d" % (prefix.lower(), len(names))
+            value = next(subexpression for root in [body] + values
+                         for subexpression in always_evaluated(root)
+                         if str(subexpression) == code)
+            replacer = SubexpressionReplacer(code, name)
+            body = replacer.visit(body)
+            values = [replacer.visit(other) for other in values]
+            names.append(name)
+            values.append(value)
+        if not names:
+            return body
+        # a value can only refer to the smaller ones found after it
+        return SharedExpression(names[::-1], values[::-1], body)
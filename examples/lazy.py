@@ -0,0 +1,359 @@
+import ast
+import copy
+import hashlib
+from ctree.c.nodes import FunctionCall, SymbolRef, FunctionDecl, Assign, \
+    ArrayRef, Return, MultiNode
+import numpy as np
+
+from kernel_cache import KernelCache
+from np_functional import BaseNpFunctionalTransformer, NpReduceTransformer, \
+    NpFunctionalTransformer, BasicTranslator, constant, loop, symbol
+from lambda_optimizer import count_operations
+
+# operators a deferred call is built from, any other falls back to running
+# the call when it's made
+LAZY_OPERATORS = ('np_map', 'np_elementwise', 'np_reduce')
+
+# (translator class, graph structure, optimize_lambdas, precision,
+# instrument) -> translator of the fused function. A program building graphs
+# of many shapes would keep every one of them and its kernels, so the least
+# recently forced go once there are MAX_FUSED, and their libraries are closed
+# with them
+MAX_FUSED = 64
+FUSED = KernelCache(MAX_FUSED)
+
+
+def np_fused_map(function, out, *arrays):
+    vec_func = np.frompyfunc(function, len(arrays), 1)
+    out[...] = vec_func(*arrays)
+    return out
+
+
+def np_fused_reduce(function, element, *arrays):
+    vec_func = np.frompyfunc(element, len(arrays), 1)
+    return reduce(function, vec_func(*arrays).flat)
+
+
+@NpFunctionalTransformer.register
+class NpFusedMapTransformer(BaseNpFunctionalTransformer):
+    func_name = "np_fused_map"
+
+    def get_axis(self, node):
+        if node.keywords:
+            raise Exception("%s takes no keyword arguments" % self.func_name)
+        return None
+
+    def get_bytes_moved(self):
+        # the output is only written
+        return sum(int(np.prod(array_type._shape_)) *
+                   array_type._dtype_.itemsize
+                   for array_type in self.array_types)
+
+    def get_func_def(self, inner_function):
+        out_type = self.array_types[0]
+        names = ["A%d" % index for index in range(len(self.array_types) - 1)]
+        params = [SymbolRef("OUT", out_type())] + [
+            SymbolRef(name, array_type())
+            for name, array_type in zip(names, self.array_types[1:])]
+        defn = self.get_alignment_hints(["OUT"] + names) + [
+            loop("i", 0, int(np.prod(out_type._shape_)), [
+                Assign(ArrayRef(symbol("OUT"), symbol("i")),
+                       FunctionCall(inner_function,
+                                    [ArrayRef(symbol(name), symbol("i"))
+                                     for name in names])),
+            ]),
+            Return(symbol("OUT")),
+        ]
+        return FunctionDecl(out_type(), self.gen_func_name, params, defn)
+
+
+@NpFunctionalTransformer.register
+class NpFusedReduceTransformer(NpReduceTransformer):
+    func_name = "np_fused_reduce"
+
+    def convert(self, node):
+        # the element lambda is lifted once the arrays it reads are known
+        self.element_function = node.args[1]
+        node.args = [node.args[0]] + node.args[2:]
+        return super(NpFusedReduceTransformer, self).convert(node)
+
+    def get_axis(self, node):
+        if node.keywords:
+            raise Exception("%s takes no keyword arguments" % self.func_name)
+        return None
+
+    def get_operations(self):
+        return super(NpFusedReduceTransformer, self).get_operations() + \
+            int(np.prod(self.array_types[0]._shape_)) * \
+            count_operations(self.element_macro.body)
+
+    def get_func_def(self, inner_function):
+        element_function = self.lift(self.element_function)
+        self.element_macro = self.lifted_functions[-1]
+        names = ["A%d" % index for index in range(len(self.array_types))]
+        params = [SymbolRef(name, array_type())
+                  for name, array_type in zip(names, self.array_types)]
+        number_items = int(np.prod(self.array_types[0]._shape_))
+
+        def element(index):
+            return FunctionCall(element_function,
+                                [ArrayRef(symbol(name), index)
+                                 for name in names])
+
+        if self.use_lanes(number_items):
+            reduction = self.get_lane_reduction(inner_function, element,
+                                                number_items)
+        else:
+            reduction = [
+                Assign(symbol("accumulator"), element(constant(0))),
+                loop("i", 1, number_items, [
+                    Assign(symbol("accumulator"),
+                           FunctionCall(inner_function,
+                                        [symbol("accumulator"),
+                                         element(symbol("i"))])),
+                ]),
+            ]
+        defn = self.get_alignment_hints(names) + reduction + [
+            Return(symbol("accumulator")),
+        ]
+        return FunctionDecl(None, self.gen_func_name, params, defn)
+
+
+class Leaf(object):
+    def __init__(self, array):
+        self.array = array
+        self.dtype = array.dtype
+        self.shape = array.shape
+
+
+class Operation(object):
+    def __init__(self, func_name, function, description, children):
+        self.func_name = func_name
+        self.function = function
+        # the dumped lambda, what the fused function is cached by
+        self.description = description
+        self.children = children
+        # what the kernels called one at a time would store: the type of
+        # the first array, and a scalar out of a reduction
+        self.dtype = children[0].dtype
+        self.shape = () if func_name == 'np_reduce' else children[0].shape
+
+
+class Substituter(ast.NodeTransformer):
+    def __init__(self, expressions):
+        self.expressions = expressions
+
+    def visit_Name(self, node):
+        if node.id in self.expressions:
+            return copy.deepcopy(self.expressions[node.id])
+        return node
+
+    def visit_Lambda(self, node):
+        # a nested lambda's own parameters hide the outer ones
+        if any(arg.id in self.expressions for arg in node.args.args):
+            return node
+        return self.generic_visit(node)
+
+
+def variable(identifier, context=ast.Load):
+    return ast.Name(id=identifier, ctx=context())
+
+
+def lambda_of(params, body):
+    return ast.Lambda(args=ast.arguments(args=[variable(param, ast.Param)
+                                               for param in params],
+                                         vararg=None, kwarg=None,
+                                         defaults=[]),
+                      body=body)
+
+
+class Graph(object):
+    # the arrays of a deferred result in the order they are first reached,
+    # each array once however often it's used
+    def __init__(self, root):
+        self.root = root
+        self.leaves = []
+        self.indices = {}
+        self.structure = self.describe(root)
+
+    def describe(self, node):
+        # the same structure, lambdas and array positions give the same
+        # fused function whatever the arrays hold
+        if isinstance(node, Leaf):
+            if id(node.array) not in self.indices:
+                self.indices[id(node.array)] = len(self.leaves)
+                self.leaves.append(node.array)
+            return self.indices[id(node.array)]
+        return (node.func_name, node.description,
+                tuple(self.describe(child) for child in node.children))
+
+    def expression(self, node):
+        # the lambdas applied to each other, one expression of the arrays'
+        # elements that the lambda optimizer sees whole
+        if isinstance(node, Leaf):
+            return variable("x%d" % self.indices[id(node.array)])
+        return Substituter(dict(
+            (arg.id, self.expression(child)) for arg, child
+            in zip(node.function.args.args, node.children))).visit(
+            copy.deepcopy(node.function.body))
+
+    def get_tree(self):
+        params = ["a%d" % index for index in range(len(self.leaves))]
+        element = lambda_of(["x%d" % index
+                             for index in range(len(self.leaves))],
+                            self.expression(self.root.children[0]
+                                            if self.root.func_name ==
+                                            'np_reduce' else self.root))
+        if self.root.func_name == 'np_reduce':
+            call = ast.Call(func=variable('np_fused_reduce'),
+                            args=[copy.deepcopy(self.root.function),
+                                  element] + [variable(param)
+                                              for param in params],
+                            keywords=[], starargs=None, kwargs=None)
+        else:
+            params = ["out"] + params
+            call = ast.Call(func=variable('np_fused_map'),
+                            args=[element] + [variable(param)
+                                              for param in params],
+                            keywords=[], starargs=None, kwargs=None)
+        return MultiNode(body=[ast.FunctionDef(
+            name='apply',
+            args=ast.arguments(args=[variable(param, ast.Param)
+                                     for param in params],
+                               vararg=None, kwarg=None, defaults=[]),
+            body=[ast.Return(value=call)], decorator_list=[])])
+
+
+class Deferred(object):
+    # the result of a lazy call, computed with everything it depends on in
+    # one kernel the first time it's needed
+    def __init__(self, translator, node):
+        self.translator = translator
+        self.node = node
+        self.dtype = node.dtype
+        self.shape = node.shape
+        self.value = None
+
+    def force(self):
+        if self.node is not None:
+            self.value = self.translator.evaluate(self.node)
+            # the arrays of the graph are only kept alive by the result
+            self.node = None
+        return self.value
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.force(), dtype)
+
+    def __float__(self):
+        return float(self.force())
+
+    def __int__(self):
+        return int(self.force())
+
+    def __repr__(self):
+        if self.node is None:
+            return "Deferred(%r)" % (self.value,)
+        return "Deferred(%s, shape=%s, pending)" % (self.dtype, self.shape)
+
+
+def force(value):
+    return value.force() if isinstance(value, Deferred) else value
+
+
+def get_node(value):
+    # an unforced result joins the graph, a forced one is an array again
+    if isinstance(value, Deferred):
+        if value.node is not None:
+            return value.node
+        value = value.value
+    if isinstance(value, np.ndarray) and value.flags['C_CONTIGUOUS']:
+        return Leaf(value)
+    return None
+
+
+class LazyTranslator(BasicTranslator):
+    # calls return Deferred results instead of running, a chain of them is
+    # fused into one kernel when a result is forced
+    def __init__(self, *args, **kwargs):
+        super(LazyTranslator, self).__init__(*args, **kwargs)
+        self.operations = self.get_operations()
+
+    def get_operations(self):
+        # the function has to be a single expression of the lazy operators
+        # on its parameters, without keyword arguments
+        func_def = next(node for node in ast.walk(self._original_tree)
+                        if isinstance(node, ast.FunctionDef))
+        if len(func_def.body) != 1 or \
+                not isinstance(func_def.body[0], ast.Return):
+            return None
+        params = [arg.id for arg in func_def.args.args]
+
+        def is_lazy(node):
+            if isinstance(node, ast.Name):
+                return node.id in params
+            return isinstance(node, ast.Call) and \
+                getattr(node.func, 'id', None) in LAZY_OPERATORS and \
+                not node.keywords and node.args and \
+                isinstance(node.args[0], ast.Lambda) and \
+                all(is_lazy(arg) for arg in node.args[1:])
+
+        if not is_lazy(func_def.body[0].value):
+            return None
+        # dumped once, not every time a result is forced
+        descriptions = dict(
+            (node, ast.dump(node.args[0]))
+            for node in ast.walk(func_def.body[0].value)
+            if isinstance(node, ast.Call))
+        return params, func_def.body[0].value, descriptions
+
+    def __call__(self, *args, **kwargs):
+        node = None
+        if self.operations is not None and not kwargs:
+            node = self.build(args)
+        if node is None:
+            return super(LazyTranslator, self).__call__(
+                *[force(arg) for arg in args], **kwargs)
+        return Deferred(self, node)
+
+    def build(self, args):
+        params, expression, descriptions = self.operations
+        if len(args) != len(params):
+            return None
+        nodes = dict(zip(params, [get_node(arg) for arg in args]))
+
+        def visit(node):
+            if isinstance(node, ast.Name):
+                return nodes[node.id]
+            children = [visit(arg) for arg in node.args[1:]]
+            if any(child is None or child.shape == () for child in children):
+                return None
+            # numpy broadcasting goes through the kernels one at a time
+            if len(set(child.shape for child in children)) != 1:
+                return None
+            return Operation(node.func.id, node.args[0], descriptions[node],
+                             children)
+
+        return visit(expression)
+
+    def evaluate(self, node):
+        if isinstance(node, Leaf):
+            return node.array
+        graph = Graph(node)
+        # with the attributes get_dispatch_key reads, which may be set on
+        # this instance
+        key = (type(self), graph.structure, self.optimize_lambdas,
+               self.precision, self.instrument)
+        translator = FUSED.get(key)
+        if translator is None:
+            # named after the structure, its files and entry types are its
+            # own
+            sub_dir = "fused_" + hashlib.sha1(repr(key)).hexdigest()[:16]
+            translator = type(self)(py_ast=graph.get_tree(), sub_dir=sub_dir)
+            translator.optimize_lambdas = self.optimize_lambdas
+            translator.precision = self.precision
+            translator.instrument = self.instrument
+            FUSED.put(key, translator)
+        args = graph.leaves
+        if node.func_name != 'np_reduce':
+            args = [np.empty(node.shape, node.dtype)] + args
+        return translator(*args)
@@ -1,28 +1,140 @@
-from ast import Lambda
-from ctypes import c_int
-import ctypes
+from ast import Lambda, Name, dump, literal_eval
+from ctypes import CFUNCTYPE, c_char_p, c_int, c_long
+import hashlib
+import inspect
+import os
+import threading
 import ctree
 from ctree.c.nodes import FunctionCall, SymbolRef, FunctionDecl, For, Assign, \
-    Constant, Lt, PreInc, ArrayRef, Return, CFile
-from ctree.cpp.nodes import CppDefine
-from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
+    Constant, Lt, PreInc, ArrayRef, Return, CFile, ArrayDef, Array, Add, Mul, \
+    Sub, If, NotEq, AddAssign, CNode, TernaryOp
+from ctree.jit import ConcreteSpecializedFunction
 from ctree.nodes import Project
-from ctree.transformations import PyBasicConversions
+from ctree.tune import ConstantTuningDriver
+from ctree.types import get_c_type_from_numpy_dtype
 from ctree.visitors import NodeTransformer
 import numpy as np
 
-import logging
-logging.basicConfig(level=20)
+# type_inference brings in lambda_optimizer, the other helpers and the ctree
+# modules only code generation needs are imported when first used
+from cache_dirs import makedirs
+from lambda_optimizer import LambdaOptimizer, count_operations, \
+    is_associative
+from type_inference import TypeInferringTranslator, describe_ctype, \
+    ctype_from_description
 
+# floating point precision policy -> flags added to the compiler's. strict
+# keeps IEEE semantics, reassociate lets the compiler reorder sums and
+# products, which vectorizes reductions, and fast_math goes all the way
+PRECISION_FLAGS = {
+    'strict': "",
+    'reassociate': "-fassociative-math -fno-signed-zeros -fno-trapping-math "
+                   "-ftree-vectorize",
+    'fast_math': "-ffast-math -ftree-vectorize",
+}
 
-def np_map(function, array):
-    vec_func = np.frompyfunc(function, 1, 1)
-    array[:] = vec_func(array)
+
+# guards adding the config targets of the precision policies
+CONFIG_LOCK = threading.Lock()
+
+
+def add_precision_target(target):
+    # <config target>_<policy> for a relaxed policy, added to ctree's
+    # configuration the first time a kernel is built with it, or found on
+    # a cached source, rather than when this is imported
+    with CONFIG_LOCK:
+        if ctree.CONFIG.has_section(target):
+            return
+        for precision, flags in PRECISION_FLAGS.items():
+            suffix = "_" + precision
+            config_target = target[:-len(suffix)]
+            if not flags or not target.endswith(suffix) or \
+                    not ctree.CONFIG.has_section(config_target):
+                continue
+            ctree.CONFIG.add_section(target)
+            for option in ('CC', 'LDFLAGS'):
+                ctree.CONFIG.set(target, option,
+                                 ctree.CONFIG.get(config_target, option))
+            ctree.CONFIG.set(target, 'CFLAGS', "%s %s" % (
+                ctree.CONFIG.get(config_target, 'CFLAGS'), flags))
+            return
+
+
+def precision_target(config_target, precision):
+    # each relaxed policy gets a config target of its own, the flags then
+    # reach the compiler with either build path and the built libraries
+    # and cached sources of the policies are kept apart
+    if precision not in PRECISION_FLAGS:
+        raise Exception("unknown precision %s, expected one of %s" %
+                        (precision, ", ".join(sorted(PRECISION_FLAGS))))
+    if precision == 'strict':
+        return config_target
+    if not ctree.CONFIG.has_section(config_target):
+        raise Exception("no %s precision target for %s" %
+                        (precision, config_target))
+    target = "%s_%s" % (config_target, precision)
+    add_precision_target(target)
+    return target
+
+
+# the clock and counters of instrumented kernels. KERNEL_NAMES lists them,
+# each has a <name>_stats array of its calls, the nanoseconds spent in them
+# and the bytes and operations of one call
+KERNEL_TIMING = """\
+    #define _POSIX_C_SOURCE 199309L
+    #include <time.h>
+    const char *KERNEL_NAMES = "%s";
+    static long kernel_clock(void) {
+        struct timespec now;
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        return now.tv_sec * 1000000000L + now.tv_nsec;
+    }
+    static void kernel_record(long *stats, long start) {
+        __sync_fetch_and_add(&stats[0], 1);
+        __sync_fetch_and_add(&stats[1], kernel_clock() - start);
+    }
+"""
+
+
+def kernel_timing(lifted_functions):
+    # goes first in the file, before any other include
+    names = [node.target.name[:-len("_stats")] for node in lifted_functions
+             if isinstance(node, ArrayDef) and
+             node.target.name.endswith("_stats")]
+    if not names:
+        return []
+    from ctree.templates.nodes import StringTemplate
+    return [StringTemplate(KERNEL_TIMING % " ".join(names))]
+
+
+def normalize_axis(func_name, axis, ndim):
+    # the Python versions and the kernels take the same axes
+    if axis is None:
+        return None
+    if not -ndim <= axis < ndim:
+        raise Exception("axis %d is out of bounds for %s of a %d-d array" %
+                        (axis, func_name, ndim))
+    return axis % ndim
+
+
+def np_map(function, array, axis=None):
+    axis = normalize_axis('np_map', axis, array.ndim)
+    if axis is None:
+        vec_func = np.frompyfunc(function, 1, 1)
+        array[:] = vec_func(array)
+    else:
+        # the function also gets the index of the element along the axis
+        vec_func = np.frompyfunc(function, 2, 1)
+        array[:] = vec_func(array, np.indices(array.shape)[axis])
     return array
 
 
-def np_reduce(function, array):
-    return reduce(function, array.flat)
+def np_reduce(function, array, axis=None):
+    axis = normalize_axis('np_reduce', axis, array.ndim)
+    if axis is None or array.ndim == 1:
+        return reduce(function, array.flat)
+    return np.apply_along_axis(lambda vector: reduce(function, vector), axis,
+                               array)
 
 
 def np_elementwise(function, array1, array2):
@@ -30,30 +142,130 @@ def np_elementwise(function, array1, array2):
     return array1
 
 
+def np_scan(function, array):
+    # inclusive, in place and over the flattened array
+    vec_func = np.frompyfunc(function, 2, 1)
+    array.flat[:] = vec_func.accumulate(array.ravel(), dtype=object)
+    return array
+
+
+def np_filter(function, array, out):
+    # the kept items go to the front of out, their number is returned
+    vec_func = np.frompyfunc(function, 1, 1)
+    kept = array.ravel()[vec_func(array.ravel()).astype(bool)]
+    out.flat[:len(kept)] = kept
+    return len(kept)
+
+
+# untyped uses of a name and constants are never changed once built, so the
+# kernels share one node for each instead of allocating thousands of them
+SYMBOLS = {}
+CONSTANTS = {}
+
+
+def symbol(name):
+    if name not in SYMBOLS:
+        SYMBOLS[name] = SymbolRef(intern(name))
+    return SYMBOLS[name]
+
+
+def constant(value):
+    key = type(value), value
+    if key not in CONSTANTS:
+        CONSTANTS[key] = Constant(value)
+    return CONSTANTS[key]
+
+
 class LambdaLifter(NodeTransformer):
     lambda_counter = 0
+    # stateless, one converter does for all the lambdas. Made with the
+    # first one, ctree.transformations isn't needed to import this
+    converter = None
 
-    def __init__(self):
+    def __init__(self, optimizer=None):
         self.lifted_functions = []
+        self.optimizer = optimizer
 
     def visit_Lambda(self, node):
+        from ctree.cpp.nodes import CppDefine
+        from ctree.transformations import PyBasicConversions
+        if LambdaLifter.converter is None:
+            LambdaLifter.converter = PyBasicConversions()
         self.generic_visit(node)
         macro_name = "LAMBDA_" + str(self.lambda_counter)
         LambdaLifter.lambda_counter += 1
-        node = PyBasicConversions().visit(node)
+        node = self.converter.visit(node)
         node.name = macro_name
-        macro = CppDefine(macro_name, node.params, node.defn[0].value)
+        body = node.defn[0].value
+        if self.optimizer is not None:
+            body = self.optimizer.optimize(body, macro_name)
+        macro = CppDefine(macro_name, node.params, body)
         self.lifted_functions.append(macro)
 
         return SymbolRef(macro_name)
 
 
+def alignment_class(array, largest=64):
+    # cheaper than array.ctypes.data, this runs on every call
+    address = array.__array_interface__['data'][0]
+    return min(largest, address & -address) if address else largest
+
+
+def dispatch_key(args):
+    # everything args_to_subconfig looks at in the arguments, without
+    # building any ctypes types or dicts: dtype, ndim and shape, the layout
+    # and the alignment
+    return tuple((arg.dtype, arg.shape, arg.strides, alignment_class(arg))
+                 if isinstance(arg, np.ndarray) else type(arg)
+                 for arg in args)
+
+
+def write_source(c_src_file, source):
+    # left alone when it's already there, its age tells whether the shared
+    # objects built from it are stale
+    if os.path.exists(c_src_file):
+        with open(c_src_file) as existing:
+            if existing.read() == source:
+                return
+    with open(c_src_file, 'w') as c_src:
+        c_src.write(source)
+
+
+def item_strides(array):
+    # None for the C contiguous layout the kernels assume by default
+    if array.flags.c_contiguous:
+        return None
+    if any(stride % array.itemsize for stride in array.strides):
+        raise Exception("strides %s are not a multiple of the item size %d" %
+                        (array.strides, array.itemsize))
+    return tuple(stride // array.itemsize for stride in array.strides)
+
+
+def c_strides(shape):
+    return tuple(int(np.prod(shape[dim + 1:])) for dim in range(len(shape)))
+
+
 class BaseNpFunctionalTransformer(NodeTransformer):
     lifted_functions = []
     func_count = 0
+    # parameter name -> (array type, alignment class, strides in items),
+    # shared by the operators
+    param_types = {}
+    # whether the kernels can index arrays that aren't C contiguous
+    strided = False
+    # how the lambdas are simplified and how far floating point can be
+    # reordered, set for all the operators
+    optimize_lambdas = True
+    precision = 'strict'
+    # whether the kernels count their calls and the time spent in them
+    instrument = False
 
     def __init__(self, array_type):
         self.array_type = array_type
+        self.array_types = [array_type]
+        self.alignments = [None]
+        self.strides = [None]
+        self.axis = None
 
     def visit_Call(self, node):
         self.generic_visit(node)
@@ -68,16 +280,128 @@ class BaseNpFunctionalTransformer(NodeTransformer):
             raise Exception(
                 self.func_name + " requires lambda to be specialized")
 
-        lambda_lifter = LambdaLifter()
-        inner_function = lambda_lifter.visit(inner_function)
+        self.array_types, self.alignments, self.strides = zip(
+            *[self.get_array_type(arg) for arg in node.args[1:]])
+        if not self.strided and any(self.strides):
+            raise Exception("%s requires C contiguous arrays to be "
+                            "specialized" % self.func_name)
+        self.axis = self.get_axis(node)
 
-        self.lifted_functions.extend(lambda_lifter.lifted_functions)
+        inner_function = self.lift(inner_function)
+        # the macro of the lambda itself comes after the nested ones
+        self.lifted_lambda = self.lifted_functions[-1]
 
         func_def = self.get_func_def(inner_function)
+        if self.instrument:
+            BaseNpFunctionalTransformer.lifted_functions.append(
+                self.get_stats_def(func_def.name))
+            func_def.defn = self.get_timed_defn(func_def.name, func_def.defn)
         BaseNpFunctionalTransformer.lifted_functions.append(func_def)
         c_node = FunctionCall(SymbolRef(func_def.name), node.args[1:])
+        c_node.array_type = self.get_result_type()
         return c_node
 
+    def lift(self, function):
+        optimizer = None
+        if self.optimize_lambdas:
+            optimizer = LambdaOptimizer(
+                self.get_param_kinds([arg.id for arg in function.args.args]),
+                self.precision)
+        lambda_lifter = LambdaLifter(optimizer)
+        function = lambda_lifter.visit(function)
+        self.lifted_functions.extend(lambda_lifter.lifted_functions)
+        return function
+
+    def get_axis(self, node):
+        for keyword in node.keywords:
+            if keyword.arg != 'axis':
+                raise Exception("%s got an unexpected keyword argument %s" %
+                                (self.func_name, keyword.arg))
+            try:
+                axis = literal_eval(keyword.value)
+            except ValueError:
+                raise Exception("%s requires a constant axis to be "
+                                "specialized" % self.func_name)
+            return normalize_axis(self.func_name, axis,
+                                  len(self.array_types[0]._shape_))
+        return None
+
+    def get_bytes_moved(self):
+        # every argument read once and the result written once, a filter
+        # counts as if it kept everything
+        result_type = self.get_result_type()
+        array_types = list(self.array_types)
+        if result_type is not None:
+            array_types.append(result_type[0])
+        return sum(int(np.prod(array_type._shape_)) *
+                   array_type._dtype_.itemsize for array_type in array_types)
+
+    def get_applications(self):
+        # how many times the lambda runs in one call
+        return int(np.prod(self.array_types[0]._shape_))
+
+    def get_operations(self):
+        return self.get_applications() * \
+            count_operations(self.lifted_lambda.body)
+
+    def get_stats_def(self, name):
+        stats = [0, 0, self.get_bytes_moved(), self.get_operations()]
+        return ArrayDef(SymbolRef(name + "_stats", c_long()),
+                        constant(len(stats)),
+                        Array(body=[constant(value) for value in stats]))
+
+    def get_timed_defn(self, name, defn):
+        # the kernels only return at the end of their body
+        timed = [Assign(SymbolRef("kernel_start", c_long()),
+                        FunctionCall(symbol("kernel_clock"), []))]
+        for statement in defn:
+            if isinstance(statement, Return):
+                timed.append(FunctionCall(symbol("kernel_record"),
+                                          [symbol(name + "_stats"),
+                                           symbol("kernel_start")]))
+            timed.append(statement)
+        return timed
+
+    def get_param_kinds(self, names):
+        # the lambda gets elements of the arrays, integers or floating point
+        # when all of them are
+        kinds = set('i' if array_type._dtype_.kind in 'iu' else
+                    'f' if array_type._dtype_.kind == 'f' else None
+                    for array_type in self.array_types)
+        if len(kinds) != 1:
+            return {}
+        return dict.fromkeys(names, kinds.pop())
+
+    def get_result_type(self):
+        # maps and elementwise operations return their first array
+        return self.array_types[0], self.alignments[0], self.strides[0]
+
+    def get_axis_extents(self):
+        # the array as (outer, axis, inner) so that any axis is walked with
+        # the same three loops and contiguous innermost accesses
+        shape = self.array_types[0]._shape_
+        return (int(np.prod(shape[:self.axis])), shape[self.axis],
+                int(np.prod(shape[self.axis + 1:])))
+
+    def get_parallel_loops(self, func_def):
+        return [func_def.find(For)]
+
+    def get_array_type(self, arg):
+        if isinstance(arg, Name) and arg.id in self.param_types:
+            return self.param_types[arg.id]
+        return getattr(arg, 'array_type', (self.array_type, None, None))
+
+    def get_alignment_hints(self, names):
+        hints = []
+        for name, array_type, alignment in zip(names, self.array_types,
+                                               self.alignments):
+            if alignment is not None and \
+                    alignment > array_type._dtype_.itemsize:
+                hints.append(Assign(symbol(name), FunctionCall(
+                    symbol("__builtin_assume_aligned"),
+                    [symbol(name), constant(alignment)])))
+        return hints
+
     @property
     def gen_func_name(self):
         name = "%s_%s" % (self.func_name, str(type(self).func_count))
@@ -94,91 +418,602 @@ class BaseNpFunctionalTransformer(NodeTransformer):
                                   % type(self))
 
 
+def loop(name, start, stop, body):
+    start, stop = [bound if isinstance(bound, CNode) else constant(bound)
+                   for bound in (start, stop)]
+    return For(Assign(SymbolRef(name, c_int()), start),
+               Lt(symbol(name), stop),
+               PreInc(symbol(name)),
+               body)
+
+
+def flat_index(*terms):
+    # terms are (index name, stride) pairs, unit extents are left out
+    index = None
+    for name, stride in terms:
+        if stride == 0:
+            continue
+        term = symbol(name)
+        if stride != 1:
+            term = Mul(term, constant(stride))
+        index = term if index is None else Add(index, term)
+    return index if index is not None else constant(0)
+
+
 class NpMapTransformer(BaseNpFunctionalTransformer):
     func_name = "np_map"
 
     def get_func_def(self, inner_function):
-        number_items = np.prod(self.array_type._shape_)
-        params = [SymbolRef("A", self.array_type())]
-        return_type = self.array_type()
-        defn = [
-            For(Assign(SymbolRef("i", c_int()), Constant(0)),
-                Lt(SymbolRef("i"), Constant(number_items)),
-                PreInc(SymbolRef("i")),
-                [
-                    Assign(ArrayRef(SymbolRef("A"), SymbolRef("i")),
-                           FunctionCall(inner_function,
-                                        [ArrayRef(SymbolRef("A"),
-                                                  SymbolRef("i"))])),
-                ]),
-            Return(SymbolRef("A")),
+        array_type = self.array_types[0]
+        number_items = np.prod(array_type._shape_)
+        params = [SymbolRef("A", array_type())]
+        return_type = array_type()
+        if self.axis is not None:
+            loops = self.get_axis_loops(inner_function)
+        else:
+            loops = [
+                For(Assign(SymbolRef("i", c_int()), constant(0)),
+                    Lt(symbol("i"), constant(number_items)),
+                    PreInc(symbol("i")),
+                    [
+                        Assign(ArrayRef(symbol("A"), symbol("i")),
+                               FunctionCall(inner_function,
+                                            [ArrayRef(symbol("A"),
+                                                      symbol("i"))])),
+                    ]),
+            ]
+        defn = self.get_alignment_hints(["A"]) + loops + [
+            Return(symbol("A")),
         ]
         return FunctionDecl(return_type, self.gen_func_name, params, defn)
 
+    def get_axis_loops(self, inner_function):
+        outer, extent, inner = self.get_axis_extents()
+        index = flat_index(("o", extent * inner), ("j", inner), ("i", 1))
+        return [
+            loop("o", 0, outer, [
+                loop("j", 0, extent, [
+                    loop("i", 0, inner, [
+                        Assign(ArrayRef(symbol("A"), index),
+                               FunctionCall(inner_function,
+                                            [ArrayRef(symbol("A"), index),
+                                             symbol("j")])),
+                    ]),
+                ]),
+            ]),
+        ]
+
 
 class NpReduceTransformer(BaseNpFunctionalTransformer):
     func_name = "np_reduce"
+    # accumulators of a reduction that may be reordered
+    reduction_lanes = 8
+
+    def get_axis(self, node):
+        axis = super(NpReduceTransformer, self).get_axis(node)
+        # reducing the only axis is a full reduction
+        if len(self.array_types[0]._shape_) == 1:
+            return None
+        return axis
+
+    def get_result_type(self):
+        if self.axis is None:
+            return None
+        return self.get_output_type(), None, None
+
+    def get_applications(self):
+        # the first element of every output is where it starts
+        items = int(np.prod(self.array_types[0]._shape_))
+        if self.axis is None:
+            return items - 1
+        return items - int(np.prod(self.get_output_type()._shape_))
+
+    def get_output_type(self):
+        array_type = self.array_types[0]
+        shape = array_type._shape_
+        return np.ctypeslib.ndpointer(
+            array_type._dtype_, len(shape) - 1,
+            shape[:self.axis] + shape[self.axis + 1:])
+
+    def get_parallel_loops(self, func_def):
+        # a full reduction carries a dependency through the accumulator
+        if self.axis is None:
+            return []
+        outer, extent, inner = self.get_axis_extents()
+        if outer > 1:
+            return [func_def.find(For)]
+        # with a single outer row the independent columns are split instead
+        return [node for node in func_def.find_all(For)
+                if node.init.left.name == "i"]
+
+    def use_lanes(self, extent):
+        # reordering the elements changes how a floating point reduction is
+        # rounded, and only gives the same result for associative lambdas
+        return self.precision != 'strict' and \
+            extent >= 2 * self.reduction_lanes and \
+            is_associative(self.lifted_lambda.params, self.lifted_lambda.body)
+
+    def get_lane_reduction(self, inner_function, element, extent):
+        # the elements go round robin into independent accumulators the
+        # compiler keeps in vector registers, they are combined at the end
+        # with the elements left over
+        names = ["lane_%d" % lane for lane in range(self.reduction_lanes)]
+        end = extent // len(names) * len(names)
+
+        def combine(name, value):
+            return Assign(symbol(name),
+                          FunctionCall(inner_function, [symbol(name), value]))
+
+        reduction = [
+            Assign(symbol(name), element(constant(lane)))
+            for lane, name in enumerate(names)
+        ] + [
+            For(Assign(SymbolRef("j", c_int()), constant(len(names))),
+                Lt(symbol("j"), constant(end)),
+                AddAssign(symbol("j"), constant(len(names))),
+                [combine(name, element(Add(symbol("j"), constant(lane))
+                                       if lane else symbol("j")))
+                 for lane, name in enumerate(names)]),
+            Assign(symbol("accumulator"), symbol(names[0])),
+        ] + [
+            combine("accumulator", symbol(name)) for name in names[1:]
+        ]
+        if end < extent:
+            reduction.append(loop("j", end, extent, [
+                combine("accumulator", element(symbol("j"))),
+            ]))
+        return reduction
 
     def get_func_def(self, inner_function):
-        number_items = np.prod(self.array_type._shape_)
-        params = [SymbolRef("A", self.array_type())]
-        elements_type = self.array_type._dtype_.type()
-        return_type = elements_type
-        defn = [
-            Assign(SymbolRef("accumulator", elements_type),
-                   ArrayRef(SymbolRef("A"), Constant(0))),
-            For(Assign(SymbolRef("i", c_int()), Constant(1)),
-                Lt(SymbolRef("i"), Constant(number_items)),
-                PreInc(SymbolRef("i")),
-                [Assign(
-                    SymbolRef("accumulator"),
-                    FunctionCall(inner_function, [SymbolRef("accumulator"),
-                                                  ArrayRef(SymbolRef("A"),
-                                                           SymbolRef("i"))])
-                )]
-                ),
-            Return(SymbolRef("accumulator")),
+        if self.axis is not None:
+            return self.get_axis_func_def(inner_function)
+        array_type = self.array_types[0]
+        number_items = np.prod(array_type._shape_)
+        params = [SymbolRef("A", array_type())]
+        if self.use_lanes(number_items):
+            reduction = self.get_lane_reduction(
+                inner_function, lambda index: ArrayRef(symbol("A"), index),
+                number_items)
+        else:
+            reduction = [
+                Assign(symbol("accumulator"),
+                       ArrayRef(symbol("A"), constant(0))),
+                For(Assign(SymbolRef("i", c_int()), constant(1)),
+                    Lt(symbol("i"), constant(number_items)),
+                    PreInc(symbol("i")),
+                    [Assign(
+                        symbol("accumulator"),
+                        FunctionCall(inner_function, [symbol("accumulator"),
+                                                      ArrayRef(symbol("A"),
+                                                               symbol("i"))])
+                    )]
+                    ),
+            ]
+        defn = self.get_alignment_hints(["A"]) + reduction + [
+            Return(symbol("accumulator")),
         ]
-        return FunctionDecl(return_type, self.gen_func_name, params, defn)
+        return FunctionDecl(None, self.gen_func_name, params, defn)
+
+    def get_axis_func_def(self, inner_function):
+        array_type = self.array_types[0]
+        output_type = self.get_output_type()
+        outer, extent, inner = self.get_axis_extents()
+        params = [SymbolRef("A", array_type())]
+        # results go to a buffer owned by the kernel, the caller copies them
+        # out before the next call
+        output = ArrayDef(
+            SymbolRef("OUT", get_c_type_from_numpy_dtype(array_type._dtype_)(),
+                      _static=True),
+            constant(np.prod(output_type._shape_)), Array(body=[constant(0)]))
+        if inner == 1 and self.use_lanes(extent):
+            loops = [
+                loop("o", 0, outer, self.get_lane_reduction(
+                    inner_function,
+                    lambda index: ArrayRef(symbol("A"), Add(
+                        flat_index(("o", extent)), index)),
+                    extent) + [
+                    Assign(ArrayRef(symbol("OUT"), symbol("o")),
+                           symbol("accumulator")),
+                ]),
+            ]
+        elif inner == 1:
+            # reducing the contiguous axis, each row goes into an accumulator
+            loops = [
+                loop("o", 0, outer, [
+                    Assign(symbol("accumulator"),
+                           ArrayRef(symbol("A"),
+                                    flat_index(("o", extent)))),
+                    loop("j", 1, extent, [
+                        Assign(symbol("accumulator"),
+                               FunctionCall(inner_function,
+                                            [symbol("accumulator"),
+                                             ArrayRef(symbol("A"),
+                                                      flat_index(
+                                                          ("o", extent),
+                                                          ("j", 1)))])),
+                    ]),
+                    Assign(ArrayRef(symbol("OUT"), symbol("o")),
+                           symbol("accumulator")),
+                ]),
+            ]
+        else:
+            # otherwise whole rows of the output are accumulated at once,
+            # walking both arrays contiguously
+            first = flat_index(("o", extent * inner), ("i", 1))
+            source = flat_index(("o", extent * inner), ("j", inner),
+                                ("i", 1))
+            target = flat_index(("o", inner), ("i", 1))
+            loops = [
+                loop("o", 0, outer, [
+                    loop("i", 0, inner, [
+                        Assign(ArrayRef(symbol("OUT"), target),
+                               ArrayRef(symbol("A"), first)),
+                    ]),
+                    loop("j", 1, extent, [
+                        loop("i", 0, inner, [
+                            Assign(ArrayRef(symbol("OUT"), target),
+                                   FunctionCall(
+                                       inner_function,
+                                       [ArrayRef(symbol("OUT"), target),
+                                        ArrayRef(symbol("A"), source)])),
+                        ]),
+                    ]),
+                ]),
+            ]
+        defn = [output] + self.get_alignment_hints(["A"]) + loops + [
+            Return(symbol("OUT")),
+        ]
+        return FunctionDecl(output_type(), self.gen_func_name, params, defn)
+
+
+def tile_loop(name, extent, tile_size, body):
+    return For(Assign(SymbolRef(name, c_int()), constant(0)),
+               Lt(symbol(name), constant(extent)),
+               AddAssign(symbol(name), constant(tile_size)),
+               body)
+
+
+def tile_end(name, extent, tile_size):
+    end = Add(symbol(name), constant(tile_size))
+    if extent % tile_size == 0:
+        return end
+    return TernaryOp(Lt(end, constant(extent)), end, constant(extent))
 
 
 class NpElementwiseTransformer(BaseNpFunctionalTransformer):
     func_name = "np_elementwise"
+    strided = True
+    # items per side of the square tiles transposed operands are walked in
+    tile_size = 32
+
+    def get_func_def(self, inner_function):
+        array_type, other_type = self.array_types
+        # the arrays may have different element types, the result is stored
+        # with the type of the first one as numpy does
+        params = [SymbolRef("A", array_type()),
+                  SymbolRef("B", other_type())]
+        return_type = array_type()
+        extents = self.get_broadcast_extents(array_type._shape_,
+                                             other_type._shape_)
+        names = ["i%d" % dim for dim in range(len(extents))]
+        a_index = flat_index(*[(name, a_stride) for name, (_, a_stride, _)
+                               in zip(names, extents)])
+        b_index = flat_index(*[(name, b_stride) for name, (_, _, b_stride)
+                               in zip(names, extents)])
+        body = [
+            Assign(ArrayRef(symbol("A"), a_index),
+                   FunctionCall(inner_function,
+                                [ArrayRef(symbol("A"), a_index),
+                                 ArrayRef(symbol("B"), b_index)])),
+        ]
+        tiled = self.get_tiled_axes(extents)
+        for dim in reversed(range(len(extents))):
+            extent = extents[dim][0]
+            if dim in tiled:
+                tile = names[dim] + "t"
+                body = [loop(names[dim], symbol(tile),
+                             tile_end(tile, extent, self.tile_size), body)]
+            else:
+                body = [loop(names[dim], 0, extent, body)]
+            if tiled and dim == tiled[0]:
+                # the tile loops go outside of the loops within the tiles
+                for tiled_dim in reversed(tiled):
+                    body = [tile_loop(names[tiled_dim] + "t",
+                                      extents[tiled_dim][0], self.tile_size,
+                                      body)]
+        defn = self.get_alignment_hints(["A", "B"]) + body + [
+            Return(symbol("A")),
+        ]
+        return FunctionDecl(return_type, self.gen_func_name, params, defn)
+
+    def get_broadcast_extents(self, shape, other_shape):
+        # (extent, stride of A, stride of B) per loop, with numpy's
+        # broadcasting rules resolved here rather than on every call
+        if len(other_shape) > len(shape):
+            raise Exception("%s can't broadcast shape %s into %s" %
+                            (self.func_name, other_shape, shape))
+        a_strides = self.strides[0] or c_strides(shape)
+        b_strides = self.strides[1] or c_strides(other_shape)
+        padding = len(shape) - len(other_shape)
+        other_shape = (1,) * padding + other_shape
+        b_strides = (0,) * padding + b_strides
+        extents = []
+        for extent, other_extent, a_stride, b_stride in zip(
+                shape, other_shape, a_strides, b_strides):
+            if other_extent == 1:
+                # broadcast axes read the same items of B again instead of
+                # a full size copy of it
+                b_stride = 0
+            elif other_extent != extent:
+                raise Exception("%s can't broadcast shape %s into %s" %
+                                (self.func_name, other_shape, shape))
+            if extent != 1:
+                extents.append((extent, a_stride, b_stride))
+        # neighbouring axes both arrays walk the same way are merged into
+        # one loop, so the usual same shape case stays a single flat loop
+        merged = extents[:1]
+        for extent, a_stride, b_stride in extents[1:]:
+            outer_extent, outer_a_stride, outer_b_stride = merged[-1]
+            if outer_a_stride == a_stride * extent and \
+                    outer_b_stride == b_stride * extent:
+                merged[-1] = (outer_extent * extent, a_stride, b_stride)
+            else:
+                merged.append((extent, a_stride, b_stride))
+        return merged or [(1, 0, 0)]
+
+    def get_tiled_axes(self, extents):
+        # when one array is walked along its rows and the other along its
+        # columns, the last two axes are walked tile by tile so that the
+        # lines of both stay in cache until all their items are used
+        if len(extents) < 2 or not self.tile_size:
+            return []
+        (outer, outer_a, outer_b), (inner, inner_a, inner_b) = extents[-2:]
+        if min(outer, inner) <= self.tile_size:
+            return []
+        if any(outer_stride != 0 and abs(inner_stride) > abs(outer_stride)
+               for outer_stride, inner_stride in [(outer_a, inner_a),
+                                                  (outer_b, inner_b)]):
+            return [len(extents) - 2, len(extents) - 1]
+        return []
+
+
+def block_bound(offset=0):
+    # BLOCKS[b + offset], the first item of a block
+    block = symbol("b")
+    if offset > 0:
+        block = Add(block, constant(offset))
+    elif offset < 0:
+        block = Sub(block, constant(-offset))
+    return ArrayRef(symbol("BLOCKS"), block)
+
+
+def block_last(offset=0):
+    return Sub(block_bound(offset + 1), constant(1))
+
+
+class BlockedTransformer(BaseNpFunctionalTransformer):
+    # below this many items splitting the array costs more than it saves
+    parallel_threshold = 1 << 16
+    number_blocks = 1
+
+    def get_axis(self, node):
+        if node.keywords:
+            raise Exception("%s works on the flattened array and takes no "
+                            "keyword arguments" % self.func_name)
+        return None
+
+    def get_parallel_loops(self, func_def):
+        # the block loops get their own pragma, every other loop carries a
+        # dependency through the running value or the output position
+        return []
+
+    def get_blocks(self, number_items):
+        number_blocks = 1
+        if number_items >= self.parallel_threshold:
+            number_blocks = max(1, self.number_blocks)
+        return [number_items * block // number_blocks
+                for block in range(number_blocks + 1)]
+
+    def get_blocks_def(self, blocks):
+        return ArrayDef(SymbolRef("BLOCKS", c_long(), _static=True,
+                                  _const=True),
+                        constant(len(blocks)),
+                        Array(body=[constant(bound) for bound in blocks]))
+
+    def get_block_loop(self, blocks, start, body):
+        block_loop = loop("b", start, len(blocks) - 1, body)
+        # a block per thread, so they have to be dealt out one at a time
+        block_loop.pragma = "omp parallel for num_threads(%d) " \
+                            "schedule(static, 1)" % (len(blocks) - 1)
+        return block_loop
+
+
+class NpScanTransformer(BlockedTransformer):
+    func_name = "np_scan"
+
+    def get_applications(self):
+        # the first element is where the prefix starts
+        return int(np.prod(self.array_types[0]._shape_)) - 1
 
     def get_func_def(self, inner_function):
-        number_items = np.prod(self.array_type._shape_)
-        params = [SymbolRef("A", self.array_type()),
-                  SymbolRef("B", self.array_type())]
-        return_type = self.array_type()
-        defn = [
-            For(Assign(SymbolRef("i", c_int()), Constant(0)),
-                Lt(SymbolRef("i"), Constant(number_items)),
-                PreInc(SymbolRef("i")),
-                [
-                    Assign(ArrayRef(SymbolRef("A"), SymbolRef("i")),
+        array_type = self.array_types[0]
+        number_items = int(np.prod(array_type._shape_))
+        blocks = self.get_blocks(number_items)
+        params = [SymbolRef("A", array_type())]
+        if len(blocks) == 2:
+            loops = [
+                loop("i", 1, number_items, [
+                    Assign(ArrayRef(symbol("A"), symbol("i")),
                            FunctionCall(inner_function,
-                                        [ArrayRef(SymbolRef("A"),
-                                                  SymbolRef("i")),
-                                         ArrayRef(SymbolRef("B"),
-                                                  SymbolRef("i"))])),
+                                        [ArrayRef(symbol("A"),
+                                                  Sub(symbol("i"),
+                                                      constant(1))),
+                                         ArrayRef(symbol("A"),
+                                                  symbol("i"))])),
                 ]),
-            Return(SymbolRef("A")),
+            ]
+        else:
+            loops = [self.get_blocks_def(blocks)] + self.get_block_loops(
+                inner_function, blocks)
+        defn = self.get_alignment_hints(["A"]) + loops + [
+            Return(symbol("A")),
         ]
-        return FunctionDecl(return_type, self.gen_func_name, params, defn)
+        return FunctionDecl(array_type(), self.gen_func_name, params, defn)
+
+    def get_block_loops(self, inner_function, blocks):
+        # two passes: each block is scanned on its own, then the blocks are
+        # offset by everything before them, only the carries are serial
+        return [
+            self.get_block_loop(blocks, 0, [
+                loop("i", Add(block_bound(), constant(1)), block_bound(1), [
+                    Assign(ArrayRef(symbol("A"), symbol("i")),
+                           FunctionCall(inner_function,
+                                        [ArrayRef(symbol("A"),
+                                                  Sub(symbol("i"),
+                                                      constant(1))),
+                                         ArrayRef(symbol("A"),
+                                                  symbol("i"))])),
+                ]),
+            ]),
+            loop("b", 1, len(blocks) - 1, [
+                Assign(ArrayRef(symbol("A"), block_last()),
+                       FunctionCall(inner_function,
+                                    [ArrayRef(symbol("A"),
+                                              block_last(-1)),
+                                     ArrayRef(symbol("A"),
+                                              block_last())])),
+            ]),
+            self.get_block_loop(blocks, 1, [
+                loop("i", block_bound(), block_last(), [
+                    Assign(ArrayRef(symbol("A"), symbol("i")),
+                           FunctionCall(inner_function,
+                                        [ArrayRef(symbol("A"),
+                                                  block_last(-1)),
+                                         ArrayRef(symbol("A"),
+                                                  symbol("i"))])),
+                ]),
+            ]),
+        ]
+
+
+class NpFilterTransformer(BlockedTransformer):
+    func_name = "np_filter"
+
+    def get_result_type(self):
+        return None
+
+    def get_func_def(self, inner_function):
+        array_type, out_type = self.array_types
+        number_items = int(np.prod(array_type._shape_))
+        if np.prod(out_type._shape_) < number_items:
+            raise Exception("%s requires an output with room for all %d "
+                            "items" % (self.func_name, number_items))
+        blocks = self.get_blocks(number_items)
+        params = [SymbolRef("A", array_type()), SymbolRef("OUT", out_type())]
+        if len(blocks) == 2:
+            loops = [
+                Assign(SymbolRef("count", c_long()), constant(0)),
+                loop("i", 0, number_items, [
+                    self.get_write(inner_function, "count"),
+                ]),
+                Return(symbol("count")),
+            ]
+        else:
+            loops = [self.get_blocks_def(blocks)] + self.get_block_loops(
+                inner_function, blocks)
+        defn = self.get_alignment_hints(["A", "OUT"]) + loops
+        return FunctionDecl(c_long(), self.gen_func_name, params, defn)
+
+    def get_write(self, inner_function, position):
+        return If(FunctionCall(inner_function,
+                               [ArrayRef(symbol("A"), symbol("i"))]),
+                  [Assign(ArrayRef(symbol("OUT"), symbol(position)),
+                          ArrayRef(symbol("A"), symbol("i"))),
+                   AddAssign(symbol(position), constant(1))])
 
+    def get_block_loops(self, inner_function, blocks):
+        # count then write: the kept items of each block are counted, the
+        # counts give every block its own slice of the output to fill
+        number_blocks = len(blocks) - 1
+        return [
+            ArrayDef(SymbolRef("OFFSETS", c_long()),
+                     constant(number_blocks + 1), Array(body=[constant(0)])),
+            self.get_block_loop(blocks, 0, [
+                Assign(SymbolRef("count", c_long()), constant(0)),
+                loop("i", block_bound(), block_bound(1), [
+                    AddAssign(symbol("count"), NotEq(
+                        FunctionCall(inner_function,
+                                     [ArrayRef(symbol("A"),
+                                               symbol("i"))]),
+                        constant(0))),
+                ]),
+                Assign(ArrayRef(symbol("OFFSETS"),
+                                Add(symbol("b"), constant(1))),
+                       symbol("count")),
+            ]),
+            loop("b", 1, number_blocks + 1, [
+                AddAssign(ArrayRef(symbol("OFFSETS"), symbol("b")),
+                          ArrayRef(symbol("OFFSETS"),
+                                   Sub(symbol("b"), constant(1)))),
+            ]),
+            self.get_block_loop(blocks, 0, [
+                Assign(SymbolRef("position", c_long()),
+                       ArrayRef(symbol("OFFSETS"), symbol("b"))),
+                loop("i", block_bound(), block_bound(1), [
+                    self.get_write(inner_function, "position"),
+                ]),
+            ]),
+            Return(ArrayRef(symbol("OFFSETS"), constant(number_blocks))),
+        ]
 
-class NpFunctionalTransformer(object):
+
+class NpFunctionalTransformer(NodeTransformer):
     transformers = [NpMapTransformer,
                     NpReduceTransformer,
-                    NpElementwiseTransformer]
+                    NpElementwiseTransformer,
+                    NpScanTransformer,
+                    NpFilterTransformer]
 
-    def __init__(self, array_type):
+    def __init__(self, array_type, arg_types=None, alignments=None,
+                 strides=None, optimize_lambdas=True,
+                 precision='strict', instrument=False):
         self.array_type = array_type
-
-    def visit(self, tree):
+        self.arg_types = arg_types or [array_type]
+        self.arg_alignments = alignments or [None] * len(self.arg_types)
+        self.arg_strides = strides or [None] * len(self.arg_types)
+        self.param_types = {}
+        self.operators = {}
         for transformer in self.transformers:
-            transformer(self.array_type).visit(tree)
-        return tree
+            operator = self.get_operator(transformer)
+            operator.param_types = self.param_types
+            operator.optimize_lambdas = optimize_lambdas
+            operator.precision = precision
+            operator.instrument = instrument
+            self.operators[transformer.func_name] = operator
+
+    @classmethod
+    def register(cls, transformer):
+        cls.transformers = cls.transformers + [transformer]
+        return transformer
+
+    def get_operator(self, transformer):
+        return transformer(self.array_type)
+
+    def visit_FunctionDef(self, node):
+        self.param_types.update(
+            (param.id, arg_config) for param, arg_config
+            in zip(node.args.args, zip(self.arg_types, self.arg_alignments,
+                                       self.arg_strides)))
+        self.generic_visit(node)
+        return node
+
+    def visit_Call(self, node):
+        # one walk for all the operators, nested calls are converted first
+        self.generic_visit(node)
+        operator = self.operators.get(getattr(node.func, "id", None))
+        if operator is None:
+            return node
+        return operator.convert(node)
 
     @staticmethod
     def lifted_functions():
@@ -191,46 +1026,313 @@ def sum_array(a):
     return np_reduce(lambda x, y: x+y, np_map(lambda x: x/4, a))
 
 
-class BasicTranslator(LazySpecializedFunction):
+# (translator class, tree hash) -> translator unpickled in this process
+TRANSLATORS = {}
+
+
+def load_translator(cls, tree, sub_dir, tree_hash, kernels):
+    # the same function sent again, with every task of a pool map, reuses
+    # the translator and the libraries it has already loaded
+    translator = TRANSLATORS.get((cls, tree_hash))
+    if translator is None:
+        translator = TRANSLATORS[cls, tree_hash] = cls(py_ast=tree,
+                                                       sub_dir=sub_dir)
+    for key, function in kernels:
+        if key not in translator.dispatch.entries:
+            translator.dispatch.put(key, function)
+    return translator
+
+
+class BasicTranslator(TypeInferringTranslator):
+    max_kernels = 256
+    max_kernel_bytes = 256 << 20
+    optimize_lambdas = True
+    # 'strict', 'reassociate' or 'fast_math', callers that accept results
+    # rounded differently get reductions in several lanes and the compiler
+    # flags of the policy
+    precision = 'strict'
+    # kernels built to count their calls, time and work, see kernel_stats
+    instrument = False
+
+    def __init__(self, *args, **kwargs):
+        from kernel_cache import KernelCache
+        super(BasicTranslator, self).__init__(*args, **kwargs)
+        # dispatch key -> concrete function, the loaded kernels are bounded
+        # so that a long running process seeing many shapes stays flat
+        self.dispatch = KernelCache(self.max_kernels, self.max_kernel_bytes)
+        self.tree_hash = hashlib.sha1(dump(self._original_tree)).hexdigest()
+
+    @classmethod
+    def from_function(cls, func, folder_name=''):
+        # the renamed tree, for the source file as it was when it was parsed
+        import transform_cache
+        code = func.__code__
+        if not os.path.exists(code.co_filename):
+            return super(BasicTranslator, cls).from_function(func,
+                                                             folder_name)
+        key = transform_cache.cache_key(
+            os.path.abspath(code.co_filename),
+            os.path.getmtime(code.co_filename), code.co_firstlineno,
+            func.__name__)
+        tree = transform_cache.load('ast', key)
+        if tree is None:
+            translator = super(BasicTranslator, cls).from_function(
+                func, folder_name)
+            transform_cache.store('ast', key, translator._original_tree)
+            return translator
+        return cls(py_ast=tree, sub_dir=folder_name or func.__name__)
+
+    @classmethod
+    def get_code_modules(cls):
+        # what the generated code depends on besides the modules of the
+        # translator's classes: the helpers, ctree's nodes and code
+        # generation, and the modules of transformers registered elsewhere
+        import ctree.c.codegen
+        import ctree.c.nodes
+        import ctree.codegen
+        import ctree.cpp.codegen
+        import ctree.cpp.nodes
+        import ctree.nodes
+        import ctree.precedence
+        import ctree.templates.codegen
+        import ctree.templates.nodes
+        import ctree.transformations
+        import ctree.types
+        import kernel_cache
+        import lambda_optimizer
+        import shared_builds
+        import transform_cache
+        import type_inference
+        return [ctree.c.codegen, ctree.c.nodes, ctree.codegen,
+                ctree.cpp.codegen, ctree.cpp.nodes, ctree.nodes,
+                ctree.precedence, ctree.templates.codegen,
+                ctree.templates.nodes, ctree.transformations, ctree.types,
+                kernel_cache, lambda_optimizer, shared_builds,
+                transform_cache, type_inference] + [
+            inspect.getmodule(transformer)
+            for transformer in NpFunctionalTransformer.transformers]
+
+    def get_transform_result(self, program_config, dir_name, cache=True):
+        # the generated sources and entry type, for the specializer's code,
+        # the tree and the configuration
+        import transform_cache
+        code_hash = transform_cache.code_hash(type(self))
+        if code_hash is None or not cache:
+            return self.run_transform(program_config)
+        key = transform_cache.cache_key(
+            code_hash, self.tree_hash,
+            sorted(program_config.args_subconfig.items()),
+            program_config.tuner_subconfig)
+        cached = transform_cache.load('transform', key)
+        if cached is None:
+            transform_result = self.run_transform(program_config)
+            entry_type = self.entry_types[dir_name]
+            cached = {'sources': [(c_file.name, c_file.config_target,
+                                   c_file.codegen())
+                                  for c_file in transform_result],
+                      'restype': describe_ctype(entry_type._restype_),
+                      'argtypes': [describe_ctype(argtype)
+                                   for argtype in entry_type._argtypes_]}
+            transform_cache.store('transform', key, cached)
+        else:
+            self.set_entry_type(dir_name, CFUNCTYPE(
+                ctype_from_description(cached['restype']),
+                *[ctype_from_description(description)
+                  for description in cached['argtypes']]))
+        # written out like ctree's own cache, the files come back without a
+        # body
+        c_files = []
+        for name, config_target, source in cached['sources']:
+            add_precision_target(config_target)
+            c_file = CFile(name, [], config_target, dir_name)
+            write_source(os.path.join(dir_name, c_file.get_filename()),
+                         source)
+            c_files.append(c_file)
+        return c_files
+
+    def __reduce__(self):
+        # pickled as its tree and the kernels built so far, which the
+        # unpickling process loads from their shared objects instead of
+        # compiling them again
+        kernels = [(key, entry[0])
+                   for key, entry in self.dispatch.entries.items()]
+        return (load_translator, (type(self), self._original_tree,
+                                  self.sub_dir, self.tree_hash, kernels))
+
+    def __call__(self, *args, **kwargs):
+        if kwargs:
+            return super(BasicTranslator, self).__call__(*args, **kwargs)
+        key = self.get_dispatch_key(args)
+        function = self.dispatch.get(key)
+        if function is None:
+            # while a tuner is still trying configurations the same
+            # arguments don't always get the same kernel. Once it has
+            # settled on one for them it keeps it, the dispatch key then
+            # stands for the configuration too
+            if not self.tuning_converged(args):
+                return super(BasicTranslator, self).__call__(*args)
+            function = self.dispatch.put(key, self.specialize(args))
+        return function(*args)
+
+    def tuning_converged(self, args):
+        return isinstance(self._tuner, ConstantTuningDriver)
+
+    def get_dispatch_key(self, args):
+        # with the translator's attributes args_to_subconfig also reads, set
+        # on an instance after its first call they select other kernels
+        return (self.optimize_lambdas, self.precision,
+                self.instrument) + dispatch_key(args)
+
+    def specialize(self, args):
+        # what LazySpecializedFunction.__call__ does short of running it
+        program_config = self.get_program_config(args, {})
+        dir_name = self.config_to_dirname(program_config)
+        makedirs(dir_name)
+        # not kept in concrete_functions, the dispatch table owns it
+        return self.finalize(
+            self.get_transform_result(program_config, dir_name),
+            program_config)
 
     def args_to_subconfig(self, args):
-        arg = args[0]
-        arg_type = np.ctypeslib.ndpointer(arg.dtype, arg.ndim, arg.shape)
-        return {'arg_type': arg_type}
+        arg_types = tuple(
+            np.ctypeslib.ndpointer(arg.dtype, arg.ndim, arg.shape)
+            for arg in args)
+        return {'arg_type': arg_types[0],
+                'arg_types': arg_types,
+                'alignments': tuple(alignment_class(arg) for arg in args),
+                'strides': tuple(item_strides(arg) for arg in args),
+                'optimize_lambdas': self.optimize_lambdas,
+                'precision': self.precision,
+                'instrument': self.instrument}
+
+    def args_to_types(self, args_subconfig):
+        return [arg_type() for arg_type in args_subconfig['arg_types']]
 
     def transform(self, tree, program_config):
-        arg_type = program_config.args_subconfig['arg_type']
-        tree = NpFunctionalTransformer(arg_type).visit(tree)
+        from ctree.transformations import PyBasicConversions
+        arg_config = program_config.args_subconfig
+        # the kernels of the previous specializations don't belong in this
+        # one's file, or in its report when instrumented
+        del NpFunctionalTransformer.lifted_functions()[:]
+        tree = NpFunctionalTransformer(arg_config['arg_type'],
+                                       arg_config['arg_types'],
+                                       arg_config['alignments'],
+                                       arg_config['strides'],
+                                       arg_config['optimize_lambdas'],
+                                       arg_config['precision'],
+                                       arg_config['instrument']).visit(tree)
         tree = PyBasicConversions().visit(tree)
 
-        fn = tree.find(FunctionDecl, name="apply")
-        fn.params[0].type = arg_type()
-        fn.return_type = arg_type._dtype_.type()
+        lifted_functions = list(NpFunctionalTransformer.lifted_functions())
+        c_translator = CFile("generated", [kernel_timing(lifted_functions),
+                                           lifted_functions, tree],
+                             precision_target('c', arg_config['precision']))
 
-        lifted_functions = NpFunctionalTransformer.lifted_functions()
-        c_translator = CFile("generated", [lifted_functions, tree])
-
-        return [c_translator]
+        return [self.infer_types(c_translator, program_config)]
 
     def finalize(self, transform_result, program_config):
         proj = Project(transform_result)
-
-        arg_config, tuner_config = program_config
-        arg_type = arg_config['arg_type']
-        entry_type = ctypes.CFUNCTYPE(arg_type._dtype_.type, arg_type)
+        entry_type = self.get_entry_type(program_config)
 
         return BasicFunction("apply", proj, entry_type)
 
 
 class BasicFunction(ConcreteSpecializedFunction):
+    # build through the lock coordinated cache shared by all processes
+    shared_builds = True
+
     def __init__(self, entry_name, project_node, entry_typesig):
-        self._c_function = self._compile(entry_name, project_node, entry_typesig)
+        from shared_builds import build_shared_object
+        if self.shared_builds:
+            self.so_file = build_shared_object(
+                [f for f in project_node.files if isinstance(f, CFile)])
+        else:
+            self._module = project_node.codegen()
+            self.so_file = self._module.so_file_name
+        # loaded here rather than by ctree so that the library can be
+        # closed again, one dlclose for the one dlopen
+        self.load(entry_name, entry_typesig._argtypes_,
+                  entry_typesig._restype_)
+
+    def load(self, entry_name, argtypes, restype):
+        from kernel_cache import SharedLibrary
+        self.entry_name = entry_name
+        self.nbytes = os.path.getsize(self.so_file)
+        self._lib = SharedLibrary(self.so_file)
+        self._c_function = self._lib[entry_name]
+        self._c_function.argtypes = argtypes
+        self._c_function.restype = restype
+        # the counters of an instrumented build, read in place
+        try:
+            names = c_char_p.in_dll(self._lib, "KERNEL_NAMES").value.split()
+        except ValueError:
+            names = []
+        # the counters point into the library without referring to it
+        self.kernel_counters = [
+            (name, (c_long * 4).in_dll(self._lib, name + "_stats"), self._lib)
+            for name in names]
+
+    def kernel_stats(self):
+        # one entry per kernel of an instrumented build, none otherwise
+        stats = []
+        for name, counters, _ in self.kernel_counters:
+            calls, nanoseconds, nbytes, operations = counters
+            seconds = nanoseconds * 1e-9
+            stats.append({
+                'kernel': name, 'calls': calls, 'seconds': seconds,
+                'bytes': calls * nbytes, 'operations': calls * operations,
+                'gbytes_per_second':
+                    calls * nbytes / seconds * 1e-9 if seconds else 0.0,
+                'gflops':
+                    calls * operations / seconds * 1e-9 if seconds else 0.0})
+        return stats
+
+    def __getstate__(self):
+        # a reference to the built library rather than the loaded one
+        return {'so_file': self.so_file, 'entry_name': self.entry_name,
+                'argtypes': [describe_ctype(argtype) for argtype in
+                             self._c_function.argtypes],
+                'restype': describe_ctype(self._c_function.restype)}
+
+    def __setstate__(self, state):
+        self.so_file = state['so_file']
+        if not os.path.exists(self.so_file):
+            raise Exception("%s was built by another process and is gone, "
+                            "the function has to be specialized again" %
+                            self.so_file)
+        self.load(state['entry_name'],
+                  [ctype_from_description(description)
+                   for description in state['argtypes']],
+                  ctype_from_description(state['restype']))
+
+    def unload(self):
+        # the library is closed when whoever still holds the C function or
+        # the counters lets go of them too
+        del self._c_function, self._lib, self.kernel_counters
 
     def __call__(self, *args, **kwargs):
-        return self._c_function(*args, **kwargs)
+        result = self._c_function(*args, **kwargs)
+        if not isinstance(result, np.ndarray):
+            return result
+        # ctypes builds a C contiguous view from the returned pointer, the
+        # argument itself is returned to keep its strides
+        address = result.__array_interface__['data'][0]
+        for arg in args:
+            if isinstance(arg, np.ndarray) and \
+                    arg.__array_interface__['data'][0] == address and \
+                    arg.shape == result.shape and arg.dtype == result.dtype:
+                return arg
+        # axis reductions return a view of the buffer owned by their kernel
+        if not any(np.may_share_memory(result, arg) for arg in args):
+            return result.copy()
+        return result
 
 
 if __name__ == '__main__':
+    # configured by the script only, importing the module sets up nothing
+    import logging
+    logging.basicConfig(level=20)
+
     c_sum_array = BasicTranslator.from_function(sum_array)
 
     test_array = np.array([range(10), range(10, 20)])
@@ -1,16 +1,18 @@
 from ast import Lambda
-from ctypes import c_int
-import ctypes
+from ctypes import c_int, c_long
 import ctree
 from ctree.c.nodes import FunctionCall, SymbolRef, FunctionDecl, For, Assign, \
-    Constant, Lt, PreInc, ArrayRef, Return, CFile, MultiNode
+    Constant, Lt, PreInc, ArrayRef, Return, CFile, MultiNode, Sub, If, \
+    AddAssign
 from ctree.cpp.nodes import CppDefine
-from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
+from ctree.jit import ConcreteSpecializedFunction
 from ctree.nodes import Project
 from ctree.transformations import PyBasicConversions
 from ctree.visitors import NodeTransformer
 import numpy as np
 
+from type_inference import TypeInferringTranslator
+
 
 def np_map(function, array):
     vec_func = np.frompyfunc(function, 1, 1)
@@ -27,6 +29,19 @@ def np_elementwise(function, array1, array2):
     return array1
 
 
+def np_scan(function, array):
+    vec_func = np.frompyfunc(function, 2, 1)
+    array.flat[:] = vec_func.accumulate(array.ravel(), dtype=object)
+    return array
+
+
+def np_filter(function, array, out):
+    vec_func = np.frompyfunc(function, 1, 1)
+    kept = array.ravel()[vec_func(array.ravel()).astype(bool)]
+    out.flat[:len(kept)] = kept
+    return len(kept)
+
+
 class LambdaLifter(NodeTransformer):
     lambda_counter = 0
 
@@ -46,6 +61,8 @@ class LambdaLifter(NodeTransformer):
 
 
 class BaseNpFunctionalTransformer(NodeTransformer):
+    _count = 0
+
     def __init__(self, array_type):
         self.array_type = array_type
 
@@ -89,6 +106,17 @@ class BaseNpFunctionalTransformer(NodeTransformer):
         raise NotImplementedError("Class %s should override func_name()"
                                   % type(self))
 
+    @property
+    def count(self):
+        # numbers the variables of each operator apart from the others'
+        old_count = type(self)._count
+        type(self)._count += 1
+        return old_count
+
+    def get_applications(self):
+        # how many times the lambda runs
+        return int(np.prod(self.array_type._shape_))
+
     def get_def(self, inner_function_name, params):
         raise NotImplementedError("Class %s should override get_def()"
                                   % type(self))
@@ -116,15 +144,13 @@ class NpMapTransformer(BaseNpFunctionalTransformer):
 
 class NpReduceTransformer(BaseNpFunctionalTransformer):
     func_name = "np_reduce"
-    _count = 0
 
     def get_def(self, inner_function, params):
         array_ref = params[0]
         number_items = np.prod(self.array_type._shape_)
-        elements_type = self.array_type._dtype_.type()
         accumulator_ref = "accumulator_%i" % self.count
         defn = [
-            Assign(SymbolRef(accumulator_ref, elements_type),
+            Assign(SymbolRef(accumulator_ref),
                    ArrayRef(array_ref, Constant(0))),
             For(Assign(SymbolRef("i", c_int()), Constant(1)),
                 Lt(SymbolRef("i"), Constant(number_items)),
@@ -139,11 +165,9 @@ class NpReduceTransformer(BaseNpFunctionalTransformer):
 
         return defn, SymbolRef(accumulator_ref)
 
-    @property
-    def count(self):
-        old_count = NpReduceTransformer._count
-        NpReduceTransformer._count += 1
-        return old_count
+    def get_applications(self):
+        # the first element is where the accumulator starts
+        return int(np.prod(self.array_type._shape_)) - 1
 
 
 class NpElementwiseTransformer(BaseNpFunctionalTransformer):
@@ -166,6 +190,56 @@ class NpElementwiseTransformer(BaseNpFunctionalTransformer):
         return defn, params[0]
 
 
+class NpScanTransformer(BaseNpFunctionalTransformer):
+    func_name = "np_scan"
+
+    def get_applications(self):
+        # the first element is where the prefix starts
+        return int(np.prod(self.array_type._shape_)) - 1
+
+    def get_def(self, inner_function, params):
+        array_ref = params[0]
+        number_items = np.prod(self.array_type._shape_)
+        defn = [
+            For(Assign(SymbolRef("i", c_int()), Constant(1)),
+                Lt(SymbolRef("i"), Constant(number_items)),
+                PreInc(SymbolRef("i")),
+                [
+                    Assign(ArrayRef(array_ref, SymbolRef("i")),
+                           FunctionCall(inner_function,
+                                        [ArrayRef(array_ref,
+                                                  Sub(SymbolRef("i"),
+                                                      Constant(1))),
+                                         ArrayRef(array_ref,
+                                                  SymbolRef("i"))])),
+                ])
+        ]
+        return defn, array_ref
+
+
+class NpFilterTransformer(BaseNpFunctionalTransformer):
+    func_name = "np_filter"
+
+    def get_def(self, inner_function, params):
+        array_ref, out_ref = params
+        number_items = np.prod(self.array_type._shape_)
+        count_ref = "count_%i" % self.count
+        defn = [
+            Assign(SymbolRef(count_ref, c_long()), Constant(0)),
+            For(Assign(SymbolRef("i", c_int()), Constant(0)),
+                Lt(SymbolRef("i"), Constant(number_items)),
+                PreInc(SymbolRef("i")),
+                [
+                    If(FunctionCall(inner_function,
+                                    [ArrayRef(array_ref, SymbolRef("i"))]),
+                       [Assign(ArrayRef(out_ref, SymbolRef(count_ref)),
+                               ArrayRef(array_ref, SymbolRef("i"))),
+                        AddAssign(SymbolRef(count_ref), Constant(1))]),
+                ])
+        ]
+        return defn, SymbolRef(count_ref)
+
+
 class AssignFixer(NodeTransformer):
     def visit_Assign(self, node):
         self.generic_visit(node)
@@ -183,19 +257,35 @@ class AssignFixer(NodeTransformer):
         return MultiNode([defn, node])
 
 
-class NpFunctionalTransformer(object):
+class NpFunctionalTransformer(AssignFixer):
     transformers = [NpMapTransformer,
                     NpReduceTransformer,
-                    NpElementwiseTransformer]
+                    NpElementwiseTransformer,
+                    NpScanTransformer,
+                    NpFilterTransformer]
 
     def __init__(self, array_type):
         self.array_type = array_type
+        self.operators = dict(
+            (transformer.func_name, self.get_operator(transformer))
+            for transformer in self.transformers)
 
-    def visit(self, tree):
-        for transformer in self.transformers:
-            transformer(self.array_type).visit(tree)
-        AssignFixer().visit(tree)
-        return tree
+    @classmethod
+    def register(cls, transformer):
+        cls.transformers = cls.transformers + [transformer]
+        return transformer
+
+    def get_operator(self, transformer):
+        return transformer(self.array_type)
+
+    def visit_Call(self, node):
+        # one walk for all the operators and the assignment fixes, nested
+        # calls are converted before the Assign or Return holding them
+        self.generic_visit(node)
+        operator = self.operators.get(getattr(node.func, "id", None))
+        if operator is None:
+            return node
+        return operator.convert(node)
 
 
 def sum_array(a):
@@ -204,7 +294,7 @@ def sum_array(a):
     return np_reduce(lambda x, y: x+y, np_map(lambda x: x/4, a))
 
 
-class BasicTranslator(LazySpecializedFunction):
+class BasicTranslator(TypeInferringTranslator):
 
     def args_to_subconfig(self, args):
         arg = args[0]
@@ -216,20 +306,13 @@ class BasicTranslator(LazySpecializedFunction):
         tree = NpFunctionalTransformer(arg_type).visit(tree)
         tree = PyBasicConversions().visit(tree)
 
-        fn = tree.find(FunctionDecl, name="apply")
-        fn.params[0].type = arg_type()
-        fn.return_type = arg_type._dtype_.type()
-
         c_translator = CFile("generated", [tree])
 
-        return [c_translator]
+        return [self.infer_types(c_translator, program_config)]
 
     def finalize(self, transform_result, program_config):
         proj = Project(transform_result)
-
-        arg_config, tuner_config = program_config
-        arg_type = arg_config['arg_type']
-        entry_type = ctypes.CFUNCTYPE(arg_type._dtype_.type, arg_type)
+        entry_type = self.get_entry_type(program_config)
 
         return BasicFunction("apply", proj, entry_type)
 
@@ -0,0 +1,138 @@
+import os
+from ctree.c.nodes import For, CFile
+from ctree.transformations import PyBasicConversions
+import numpy as np
+
+from autotuner import AutotunedTranslator, expand_space
+from np_functional import NpMapTransformer, NpReduceTransformer, \
+    NpElementwiseTransformer, NpScanTransformer, NpFilterTransformer, \
+    NpFunctionalTransformer, BasicTranslator, kernel_timing, \
+    precision_target, sum_array
+
+# what multiprocessing.cpu_count() reads, without importing multiprocessing
+THREAD_COUNTS = sorted(set([1, 2, 4, os.sysconf("SC_NPROCESSORS_ONLN")]))
+
+TUNING_SPACE = (
+    expand_space(unroll=[1, 2, 4, 8]) +
+    expand_space(num_threads=THREAD_COUNTS, chunk_size=[256, 1024, 4096]) +
+    expand_space(tile_size=[16, 32, 64, 128])
+)
+
+
+def loop_pragma(tuner_config, parallel):
+    if parallel and 'num_threads' in tuner_config:
+        return "omp parallel for num_threads(%d) schedule(static, %d)" % (
+            tuner_config['num_threads'], tuner_config['chunk_size'])
+    if tuner_config.get('unroll', 1) > 1:
+        return "GCC unroll %d" % tuner_config['unroll']
+    return None
+
+
+class TunedLoops(object):
+    def __init__(self, array_type, tuner_config):
+        super(TunedLoops, self).__init__(array_type)
+        self.tuner_config = tuner_config
+
+    @property
+    def number_blocks(self):
+        # scans and filters split into a block per thread
+        return self.tuner_config.get('num_threads', 1)
+
+    @property
+    def tile_size(self):
+        # only used by the kernels that tile, the others ignore it
+        return self.tuner_config.get('tile_size',
+                                     super(TunedLoops, self).tile_size)
+
+    def get_func_def(self, inner_function):
+        func_def = super(TunedLoops, self).get_func_def(inner_function)
+        # only the loops the transformer reports as independent are
+        # parallelized, the others can still be unrolled
+        parallel_loops = self.get_parallel_loops(func_def)
+        if parallel_loops and 'num_threads' in self.tuner_config:
+            for parallel_loop in parallel_loops:
+                parallel_loop.pragma = loop_pragma(self.tuner_config, True)
+        else:
+            first_loop = func_def.find(For)
+            # block loops come with their own parallel pragma
+            if first_loop.pragma is None:
+                first_loop.pragma = loop_pragma(self.tuner_config, False)
+        return func_def
+
+
+class TunedNpMapTransformer(TunedLoops, NpMapTransformer):
+    pass
+
+
+class TunedNpReduceTransformer(TunedLoops, NpReduceTransformer):
+    pass
+
+
+class TunedNpElementwiseTransformer(TunedLoops, NpElementwiseTransformer):
+    pass
+
+
+class TunedNpScanTransformer(TunedLoops, NpScanTransformer):
+    pass
+
+
+class TunedNpFilterTransformer(TunedLoops, NpFilterTransformer):
+    pass
+
+
+class TunedNpFunctionalTransformer(NpFunctionalTransformer):
+    transformers = [TunedNpMapTransformer,
+                    TunedNpReduceTransformer,
+                    TunedNpElementwiseTransformer,
+                    TunedNpScanTransformer,
+                    TunedNpFilterTransformer]
+
+    def __init__(self, array_type, tuner_config, arg_types=None,
+                 alignments=None, strides=None, optimize_lambdas=True,
+                 precision='strict', instrument=False):
+        self.tuner_config = tuner_config
+        super(TunedNpFunctionalTransformer, self).__init__(
+            array_type, arg_types, alignments, strides, optimize_lambdas,
+            precision, instrument)
+
+    def get_operator(self, transformer):
+        return transformer(self.array_type, self.tuner_config)
+
+
+class TunedTranslator(AutotunedTranslator, BasicTranslator):
+    tuning_space = TUNING_SPACE
+
+    def transform(self, tree, program_config):
+        arg_config = program_config.args_subconfig
+        tuner_config = program_config.tuner_subconfig
+
+        # every candidate is a separate specialization, don't let the lifted
+        # functions of the previous ones pile up in this one
+        del NpFunctionalTransformer.lifted_functions()[:]
+        tree = TunedNpFunctionalTransformer(
+            arg_config['arg_type'], tuner_config, arg_config['arg_types'],
+            arg_config['alignments'], arg_config['strides'],
+            arg_config['optimize_lambdas'],
+            arg_config['precision'], arg_config['instrument']).visit(tree)
+        tree = PyBasicConversions().visit(tree)
+
+        lifted_functions = list(NpFunctionalTransformer.lifted_functions())
+        config_target = precision_target(
+            'omp' if 'num_threads' in tuner_config else 'c',
+            arg_config['precision'])
+        c_translator = CFile("generated", [kernel_timing(lifted_functions),
+                                           lifted_functions, tree],
+                             config_target=config_target)
+
+        return [self.infer_types(c_translator, program_config)]
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=20)
+
+    c_sum_array = TunedTranslator.from_function(sum_array)
+
+    for _ in range(len(TUNING_SPACE) * TunedTranslator.tuning_trials + 1):
+        result = c_sum_array(np.arange(1 << 15).reshape(1 << 5, 1 << 10))
+    print result, sum_array(np.arange(1 << 15).reshape(1 << 5, 1 << 10))
@@ -6,11 +6,12 @@ from ctree.c.nodes import FunctionCall, SymbolRef, FunctionDecl, Constant, \
 from ctree.cpp.nodes import CppDefine
 from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
 from ctree.nodes import Project
-from ctree.templates.nodes import FileTemplate
 from ctree.transformations import PyBasicConversions
 from ctree.visitors import NodeTransformer
 import numpy as np
 
+from template_cache import cached_file_template
+
 import logging
 logging.basicConfig(level=20)
 
@@ -92,7 +93,7 @@ class NpMapTransformer(BaseNpFunctionalTransformer):
         number_items = np.prod(self.array_type._shape_)
         params = [SymbolRef("A", self.array_type())]
         return_type = self.array_type()
-        defn = FileTemplate("./np_map.tmpl.c", {
+        defn = cached_file_template("./np_map.tmpl.c", {
             'NUMBER_ITEMS': Constant(number_items),
             'INNER_FUNCTION': inner_function
         })
@@ -6,11 +6,12 @@ from ctree.c.nodes import FunctionCall, SymbolRef, FunctionDecl, Constant, \
 from ctree.cpp.nodes import CppDefine
 from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
 from ctree.nodes import Project
-from ctree.templates.nodes import StringTemplate
 from ctree.transformations import PyBasicConversions
 from ctree.visitors import NodeTransformer
 import numpy as np
 
+from template_cache import cached_string_template
+
 import logging
 logging.basicConfig(level=20)
 
@@ -92,7 +93,7 @@ class NpMapTransformer(BaseNpFunctionalTransformer):
         number_items = np.prod(self.array_type._shape_)
         params = [SymbolRef("A", self.array_type())]
         return_type = self.array_type()
-        defn = StringTemplate("""\
+        defn = cached_string_template("""\
             for (int i = 0; i < $NUMBER_ITEMS; ++i) {
                 A[i] = $INNER_FUNCTION(A[i]);
             }
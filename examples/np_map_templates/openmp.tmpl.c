@@ -0,0 +1,5 @@
+#pragma omp parallel for num_threads($NUM_THREADS) schedule(static, $CHUNK_SIZE)
+for (int i = 0; i < $NUMBER_ITEMS; ++i) {
+    A[i] = $INNER_FUNCTION(A[i]);
+}
+return A;
@@ -0,0 +1,4 @@
+for (int i = 0; i < $NUMBER_ITEMS; ++i) {
+    A[i] = $INNER_FUNCTION(A[i]);
+}
+return A;
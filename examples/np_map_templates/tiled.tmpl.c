@@ -0,0 +1,9 @@
+#pragma omp parallel for num_threads($NUM_THREADS) schedule(dynamic, 1)
+for (int ii = 0; ii < $NUMBER_ITEMS; ii += $BLOCK_SIZE) {
+    int end = ii + $BLOCK_SIZE < $NUMBER_ITEMS ? ii + $BLOCK_SIZE : $NUMBER_ITEMS;
+    #pragma omp simd
+    for (int i = ii; i < end; ++i) {
+        A[i] = $INNER_FUNCTION(A[i]);
+    }
+}
+return A;
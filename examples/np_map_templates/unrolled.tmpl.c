@@ -0,0 +1,8 @@
+int i = 0;
+for (; i + $UNROLL <= $NUMBER_ITEMS; i += $UNROLL) {
+    $UNROLLED_BODY
+}
+for (; i < $NUMBER_ITEMS; ++i) {
+    A[i] = $INNER_FUNCTION(A[i]);
+}
+return A;
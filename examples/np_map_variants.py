@@ -0,0 +1,227 @@
+from ast import Lambda
+import ctypes
+import multiprocessing
+import os
+from ctree.c.nodes import FunctionCall, SymbolRef, FunctionDecl, Constant, \
+    CFile, Assign, ArrayRef, Add
+from ctree.cpp.nodes import CppDefine
+from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
+from ctree.nodes import Project
+from ctree.transformations import PyBasicConversions
+from ctree.tune import ConstantTuningDriver
+from ctree.visitors import NodeTransformer
+import numpy as np
+
+from autotuner import AutotunedTranslator, expand_space
+from template_cache import cached_file_template
+
+TEMPLATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "np_map_templates")
+
+# variant name -> (ctree config target used to compile it, default params)
+VARIANTS = {
+    'serial': ('c', {}),
+    'unrolled': ('c', {'unroll': 4}),
+    'openmp': ('omp', {'num_threads': 4, 'chunk_size': 1024}),
+    'tiled': ('omp', {'num_threads': 4, 'block_size': 4096}),
+}
+
+DEFAULT_TUNER_CONFIG = {'variant': 'serial'}
+
+THREAD_COUNTS = sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+
+TUNING_SPACE = (
+    expand_space(variant=['serial']) +
+    expand_space(variant=['unrolled'], unroll=[2, 4, 8]) +
+    expand_space(variant=['openmp'], num_threads=THREAD_COUNTS,
+                 chunk_size=[256, 1024, 4096]) +
+    expand_space(variant=['tiled'], num_threads=THREAD_COUNTS,
+                 block_size=[1024, 4096, 16384])
+)
+
+
+def get_variant_config(tuner_config):
+    # a config without a variant gets the serial loop
+    variant = dict(DEFAULT_TUNER_CONFIG, **(tuner_config or {}))['variant']
+    if variant not in VARIANTS:
+        raise Exception("unknown np_map variant: %s" % variant)
+    config = dict(VARIANTS[variant][1])
+    config.update(tuner_config or {})
+    config['variant'] = variant
+    # the template separates the statements of a body of two or more, a
+    # single one would be left without its semicolon
+    if variant == 'unrolled' and config['unroll'] < 2:
+        raise Exception("the unrolled np_map variant needs an unroll factor "
+                        "of at least 2, got %s" % config['unroll'])
+    return config
+
+
+def np_map(function, array):
+    vec_func = np.frompyfunc(function, 1, 1)
+    array[:] = vec_func(array)
+    return array
+
+
+class LambdaLifter(NodeTransformer):
+    lambda_counter = 0
+
+    def __init__(self):
+        self.lifted_functions = []
+
+    def visit_Lambda(self, node):
+        self.generic_visit(node)
+        macro_name = "LAMBDA_" + str(self.lambda_counter)
+        LambdaLifter.lambda_counter += 1
+        node = PyBasicConversions().visit(node)
+        node.name = macro_name
+        macro = CppDefine(macro_name, node.params, node.defn[0].value)
+        self.lifted_functions.append(macro)
+
+        return SymbolRef(macro_name)
+
+
+class NpMapTransformer(NodeTransformer):
+    func_name = "np_map"
+    func_count = 0
+
+    def __init__(self, array_type, tuner_config):
+        self.array_type = array_type
+        self.tuner_config = get_variant_config(tuner_config)
+        self.lifted_functions = []
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if getattr(node.func, "id", None) != self.func_name:
+            return node
+
+        return self.convert(node)
+
+    def convert(self, node):
+        inner_function = node.args[0]
+        if not isinstance(inner_function, Lambda):
+            raise Exception(
+                self.func_name + " requires lambda to be specialized")
+
+        lambda_lifter = LambdaLifter()
+        inner_function = lambda_lifter.visit(inner_function)
+
+        self.lifted_functions.extend(lambda_lifter.lifted_functions)
+
+        func_def = self.get_func_def(inner_function)
+        self.lifted_functions.append(func_def)
+        c_node = FunctionCall(SymbolRef(func_def.name), node.args[1:])
+        return c_node
+
+    @property
+    def gen_func_name(self):
+        name = "%s_%s" % (self.func_name, str(type(self).func_count))
+        type(self).func_count += 1
+        return name
+
+    @property
+    def variant(self):
+        return self.tuner_config['variant']
+
+    @property
+    def config_target(self):
+        return VARIANTS[self.variant][0]
+
+    def get_template_children(self, inner_function):
+        children = {'NUMBER_ITEMS': Constant(np.prod(self.array_type._shape_)),
+                    'INNER_FUNCTION': inner_function}
+        for key, value in self.tuner_config.items():
+            if key != 'variant':
+                children[key.upper()] = Constant(value)
+        if self.variant == 'unrolled':
+            children['UNROLLED_BODY'] = [
+                Assign(ArrayRef(SymbolRef("A"),
+                                Add(SymbolRef("i"), Constant(offset))),
+                       FunctionCall(SymbolRef(inner_function.name),
+                                    [ArrayRef(SymbolRef("A"),
+                                              Add(SymbolRef("i"),
+                                                  Constant(offset)))]))
+                for offset in range(self.tuner_config['unroll'])
+            ]
+        return children
+
+    def get_func_def(self, inner_function):
+        params = [SymbolRef("A", self.array_type())]
+        return_type = self.array_type()
+        template_path = os.path.join(TEMPLATES_PATH,
+                                     "%s.tmpl.c" % self.variant)
+        defn = cached_file_template(template_path,
+                                    self.get_template_children(inner_function))
+        return FunctionDecl(return_type, self.gen_func_name, params, [defn])
+
+
+def square_array(a):
+    np_map(lambda x: x*x, a)
+
+
+class BasicTranslator(LazySpecializedFunction):
+
+    def get_tuning_driver(self):
+        return ConstantTuningDriver(DEFAULT_TUNER_CONFIG)
+
+    def set_tuner_config(self, tuner_config):
+        get_variant_config(tuner_config)
+        self._tuner = ConstantTuningDriver(tuner_config)
+
+    def args_to_subconfig(self, args):
+        arg = args[0]
+        arg_type = np.ctypeslib.ndpointer(arg.dtype, arg.ndim, arg.shape)
+        return {'arg_type': arg_type}
+
+    def transform(self, tree, program_config):
+        arg_type = program_config.args_subconfig['arg_type']
+        transformer = NpMapTransformer(arg_type,
+                                       program_config.tuner_subconfig)
+        tree = transformer.visit(tree)
+        tree = PyBasicConversions().visit(tree)
+
+        fn = tree.find(FunctionDecl, name="apply")
+        fn.params[0].type = arg_type()
+
+        c_translator = CFile("generated", [transformer.lifted_functions, tree],
+                             config_target=transformer.config_target)
+
+        return [c_translator]
+
+    def finalize(self, transform_result, program_config):
+        proj = Project(transform_result)
+
+        arg_config, tuner_config = program_config
+        arg_type = arg_config['arg_type']
+        entry_type = ctypes.CFUNCTYPE(None, arg_type)
+
+        return BasicFunction("apply", proj, entry_type)
+
+
+class BasicFunction(ConcreteSpecializedFunction):
+    def __init__(self, entry_name, project_node, entry_typesig):
+        self._c_function = self._compile(entry_name, project_node, entry_typesig)
+
+    def __call__(self, *args, **kwargs):
+        return self._c_function(*args, **kwargs)
+
+
+class TunedTranslator(AutotunedTranslator, BasicTranslator):
+    tuning_space = TUNING_SPACE
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=20)
+
+    c_square_array = BasicTranslator.from_function(square_array)
+
+    for variant in ['serial', 'unrolled', 'openmp', 'tiled']:
+        c_square_array.set_tuner_config({'variant': variant})
+        test_array = np.arange(1000).reshape(10, 100)
+        c_square_array(test_array)
+        print variant, np.array_equal(test_array,
+                                      np.arange(1000).reshape(10, 100) ** 2)
+
+    c_tuned_square_array = TunedTranslator.from_function(square_array)
+    for _ in range(len(TUNING_SPACE) * TunedTranslator.tuning_trials + 1):
+        c_tuned_square_array(np.arange(1 << 20, dtype=np.float64))
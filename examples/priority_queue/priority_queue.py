@@ -2,18 +2,15 @@ from ctypes import Structure, POINTER
 import ctypes
 import heapq
 import os
-import ctree
 from ctree.c.nodes import FunctionDecl, SymbolRef, BinaryOp, Op, Return, \
     FunctionCall
 from ctree.c.nodes import CFile
 from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
 from ctree.nodes import Project
-from ctree.templates.nodes import StringTemplate
-from ctree.transformations import PyBasicConversions
 import numpy as np
 
 
-from examples.np_functional_inline import np_map, NpFunctionalTransformer
+from examples.support_library import SupportLibrary, get_linked_config_target
 
 import logging
 # logging.basicConfig(level=20)
@@ -42,6 +39,12 @@ class PriorityQueue(object):
         return self.codegen()
 
 
+def np_map(function, array):
+    # the Python version, the specialized one is generated by the transformer
+    from examples.np_functional_inline import np_map as inline_np_map
+    return inline_np_map(function, array)
+
+
 def priority_queue(max_size):
     return PriorityQueue(max_size)
 
@@ -60,6 +63,12 @@ from ctree.types import register_type_codegenerators
 register_type_codegenerators({
     PriorityQueue: lambda t: "struct " + type(t).__name__ + "*"})
 
+PRIORITY_QUEUE_PATH = os.path.dirname(os.path.abspath(__file__))
+PRIORITY_QUEUE_HEADER = os.path.join(PRIORITY_QUEUE_PATH, "priority_queue.h")
+PRIORITY_QUEUE_LIBRARY = SupportLibrary(
+    "priority_queue", [os.path.join(PRIORITY_QUEUE_PATH, "priority_queue.c")],
+    [PRIORITY_QUEUE_HEADER])
+
 
 class BasicTranslator(LazySpecializedFunction):
 
@@ -69,17 +78,18 @@ class BasicTranslator(LazySpecializedFunction):
         return {'arg_type': arg_type}
 
     def transform(self, tree, program_config):
+        # only needed once something is specialized, not to import this
+        from ctree.templates.nodes import StringTemplate
+        from ctree.transformations import PyBasicConversions
+        from examples.np_functional_inline import NpFunctionalTransformer
+
         arg_type = program_config.args_subconfig['arg_type']
         tree = NpFunctionalTransformer(arg_type).visit(tree)
         tree = PyBasicConversions().visit(tree)
 
-        priority_queue_path = os.path.dirname(os.path.abspath(__file__))
-        pq_header = os.path.join(priority_queue_path, "priority_queue.h")
-        pq_c = os.path.join(priority_queue_path, "priority_queue.c")
-        ctree.CONFIG.set('c', 'LDFLAGS', pq_c)
         includes = [StringTemplate("""\
             #include <stdio.h>
-            #include "%s" """ % pq_header)]
+            #include "%s" """ % PRIORITY_QUEUE_HEADER)]
         func_def = [FunctionDecl(
             return_type=PriorityQueue(),
             name="priority_queue",
@@ -90,7 +100,9 @@ class BasicTranslator(LazySpecializedFunction):
 
         fib_fn = tree.find(FunctionDecl, name="apply")
         fib_fn.params[0].type = arg_type()
-        c_translator = CFile("generated", includes + func_def + [tree])
+        c_translator = CFile(
+            "generated", includes + func_def + [tree],
+            config_target=get_linked_config_target([PRIORITY_QUEUE_LIBRARY]))
 
         return [c_translator]
 
@@ -0,0 +1,242 @@
+import ast
+import copy
+import ctypes
+import operator
+from ctree.c.nodes import FunctionDecl, FunctionCall, SymbolRef, Constant, \
+    ArrayRef, TernaryOp, BinaryOp, UnaryOp, If, Return, Block, Op, GtE, Sub, \
+    Mod
+from ctree.cpp.nodes import CppInclude
+from ctree.types import codegen_type
+from ctree.visitors import NodeTransformer
+
+from lambda_optimizer import c_div, c_mod
+from template_cache import cached_string_template
+
+INTEGER_TYPES = (ctypes.c_byte, ctypes.c_short, ctypes.c_int, ctypes.c_long,
+                 ctypes.c_longlong)
+
+PURE_NODE_TYPES = (If, Return, Block, BinaryOp, UnaryOp, TernaryOp,
+                   FunctionCall, SymbolRef, Constant)
+
+# what the base case check can evaluate, in C's integer semantics
+BINARY_OPERATORS = {Op.Add: operator.add, Op.Sub: operator.sub,
+                    Op.Mul: operator.mul, Op.Div: c_div, Op.Mod: c_mod,
+                    Op.Lt: operator.lt, Op.Gt: operator.gt,
+                    Op.LtE: operator.le, Op.GtE: operator.ge,
+                    Op.Eq: operator.eq, Op.NotEq: operator.ne}
+UNARY_OPERATORS = {Op.SubUnary: operator.neg, Op.AddUnary: operator.pos,
+                   Op.Not: operator.not_}
+
+MEMO_TEMPLATE = """\
+static $TYPE* ${NAME}_memo = NULL;
+static char* ${NAME}_known = NULL;
+static long ${NAME}_memo_size = 0;
+$TYPE $NAME($TYPE $PARAM) {
+    if ($PARAM < 0 || $PARAM >= $MEMO_LIMIT) {
+        return ${NAME}_body($PARAM);
+    }
+    if ($PARAM >= ${NAME}_memo_size) {
+        long size = 2 * ${NAME}_memo_size > $PARAM ? 2 * ${NAME}_memo_size : $PARAM + 1;
+        $TYPE* memo = realloc(${NAME}_memo, size * sizeof($TYPE));
+        char* known = realloc(${NAME}_known, size);
+        if (memo != NULL) {
+            ${NAME}_memo = memo;
+        }
+        if (known != NULL) {
+            ${NAME}_known = known;
+        }
+        if (memo == NULL || known == NULL) {
+            return ${NAME}_body($PARAM);
+        }
+        memset(${NAME}_known + ${NAME}_memo_size, 0, size - ${NAME}_memo_size);
+        ${NAME}_memo_size = size;
+    }
+    if (!${NAME}_known[$PARAM]) {
+        // the body may grow (and move) the table, so don't assign in place
+        $TYPE result = ${NAME}_body($PARAM);
+        ${NAME}_memo[$PARAM] = result;
+        ${NAME}_known[$PARAM] = 1;
+    }
+    return ${NAME}_memo[$PARAM];
+}
+"""
+
+ITERATIVE_TEMPLATE = """\
+$TYPE $NAME($TYPE $PARAM) {
+    $TYPE window[$WINDOW];
+    if ($PARAM < 0) {
+        return ${NAME}_body($PARAM);
+    }
+    for ($TYPE i = 0; i <= $PARAM; ++i) {
+        window[i % $WINDOW] = ${NAME}_step(i, window);
+    }
+    return window[$PARAM % $WINDOW];
+}
+"""
+
+
+class SelfCallReplacer(NodeTransformer):
+    def __init__(self, func_name, param_name, body_name, window):
+        self.func_name = func_name
+        self.param_name = param_name
+        self.body_name = body_name
+        self.window = window
+
+    def visit_FunctionCall(self, node):
+        self.generic_visit(node)
+        if node.func.name != self.func_name:
+            return node
+        offset = get_offset(node.args[0], self.param_name)
+        # f(n - c) is already in the window once n >= c, smaller arguments
+        # are left to the faithful recursive version
+        return TernaryOp(
+            GtE(SymbolRef(self.param_name), Constant(offset)),
+            ArrayRef(SymbolRef("window"),
+                     Mod(Sub(SymbolRef(self.param_name), Constant(offset)),
+                         Constant(self.window))),
+            FunctionCall(SymbolRef(self.body_name),
+                         [Sub(SymbolRef(self.param_name), Constant(offset))]))
+
+
+def get_offset(arg, param_name):
+    if isinstance(arg, BinaryOp) and isinstance(arg.op, Op.Sub) and \
+            getattr(arg.left, 'name', None) == param_name and \
+            isinstance(arg.right, Constant) and \
+            isinstance(arg.right.value, (int, long)) and arg.right.value > 0:
+        return arg.right.value
+    return None
+
+
+class BaseCaseEvaluator(object):
+    # runs the body for one value of the parameter, to tell whether it
+    # returns without calling itself. evaluate gives None when it calls
+    # itself or does something not followed here
+    def __init__(self, param_name, value):
+        self.param_name = param_name
+        self.value = value
+
+    def run(self, statements):
+        # (whether it returned, what), an unknown value returns None
+        for statement in statements:
+            if isinstance(statement, Return):
+                return True, self.evaluate(statement.value)
+            if isinstance(statement, If):
+                cond = self.evaluate(statement.cond)
+                if cond is None:
+                    return True, None
+                branch = (statement.then if cond else statement.elze) or []
+                returned = self.run(branch if isinstance(branch, list)
+                                    else [branch])
+            elif isinstance(statement, Block):
+                returned = self.run(statement.body)
+            else:
+                return True, None
+            if returned[0]:
+                return returned
+        return False, None
+
+    def evaluate(self, node):
+        if isinstance(node, Constant) and isinstance(node.value, (int, long)):
+            return node.value
+        if isinstance(node, SymbolRef) and node.name == self.param_name:
+            return self.value
+        if isinstance(node, TernaryOp):
+            cond = self.evaluate(node.cond)
+            if cond is None:
+                return None
+            return self.evaluate(node.then if cond else node.elze)
+        if isinstance(node, UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            arg = self.evaluate(node.arg)
+            if arg is None:
+                return None
+            return int(UNARY_OPERATORS[type(node.op)](arg))
+        if isinstance(node, BinaryOp) and isinstance(node.op, (Op.And,
+                                                               Op.Or)):
+            left = self.evaluate(node.left)
+            if left is None or bool(left) == isinstance(node.op, Op.Or):
+                return None if left is None else int(bool(left))
+            right = self.evaluate(node.right)
+            return None if right is None else int(bool(right))
+        if isinstance(node, BinaryOp) and type(node.op) in BINARY_OPERATORS:
+            left, right = self.evaluate(node.left), self.evaluate(node.right)
+            if left is None or right is None or \
+                    isinstance(node.op, (Op.Div, Op.Mod)) and right == 0:
+                return None
+            return int(BINARY_OPERATORS[type(node.op)](left, right))
+        return None
+
+
+def is_base_case(node, value):
+    returned, result = BaseCaseEvaluator(node.params[0].name, value).run(
+        node.defn)
+    return returned and result is not None
+
+
+class SelfRecursionOptimizer(NodeTransformer):
+    strategies = ("memo", "iterative")
+
+    def __init__(self, strategy="iterative", memo_limit=1 << 24):
+        if strategy not in self.strategies:
+            raise Exception("unknown recursion strategy: %s" % strategy)
+        self.strategy = strategy
+        self.memo_limit = memo_limit
+
+    def visit_FunctionDecl(self, node):
+        if not self.is_pure_self_recursive(node):
+            return node
+        param = node.params[0]
+        prototype = FunctionDecl(node.return_type, node.name,
+                                 [SymbolRef(param.name, param.type)])
+        body = FunctionDecl(node.return_type, node.name + "_body",
+                            [SymbolRef(param.name, param.type)], node.defn)
+        children = {'NAME': SymbolRef(node.name),
+                    'PARAM': SymbolRef(param.name),
+                    'TYPE': SymbolRef(codegen_type(param.type))}
+
+        offsets = self.get_offsets(node)
+        # the loop computes every value from 0 up, also those the recursion
+        # never reaches, like the odd ones of f(n - 2). Each is only safe
+        # when the base case returns below the largest offset, every step
+        # from there on reads the window alone. Anything else is memoized
+        if self.strategy == "iterative" and None not in offsets and \
+                all(is_base_case(node, value)
+                    for value in range(max(offsets))):
+            window = max(offsets) + 1
+            step = FunctionDecl(
+                node.return_type, node.name + "_step",
+                [SymbolRef(param.name, param.type),
+                 SymbolRef("window", ctypes.POINTER(type(param.type))())],
+                copy.deepcopy(node.defn))
+            step = SelfCallReplacer(node.name, param.name, body.name,
+                                    window).visit(step)
+            children['WINDOW'] = Constant(window)
+            wrapper = cached_string_template(ITERATIVE_TEMPLATE, children)
+            return [prototype, body, step, wrapper]
+
+        children['MEMO_LIMIT'] = Constant(self.memo_limit)
+        wrapper = cached_string_template(MEMO_TEMPLATE, children)
+        return [CppInclude("stdlib.h"), CppInclude("string.h"), prototype,
+                body, wrapper]
+
+    def is_pure_self_recursive(self, node):
+        if len(node.params) != 1 or \
+                not isinstance(node.params[0].type, INTEGER_TYPES):
+            return False
+        allowed_names = (node.name, node.params[0].name)
+        recursive = False
+        for child in ast.walk(Block(node.defn)):
+            if not isinstance(child, PURE_NODE_TYPES):
+                return False
+            if isinstance(child, SymbolRef) and \
+                    child.name not in allowed_names:
+                return False
+            if isinstance(child, FunctionCall):
+                if getattr(child.func, 'name', None) != node.name or \
+                        len(child.args) != 1:
+                    return False
+                recursive = True
+        return recursive
+
+    def get_offsets(self, node):
+        return [get_offset(call.args[0], node.params[0].name)
+                for call in Block(node.defn).find_all(FunctionCall)]
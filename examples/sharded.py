@@ -0,0 +1,232 @@
+import ast
+import atexit
+import itertools
+import multiprocessing
+import os
+import tempfile
+import numpy as np
+from cache_dirs import makedirs
+
+# python 2 has no multiprocessing.shared_memory, a file in a tmpfs mapped by
+# every process is the same thing with a name the workers can open
+SHARED_PATH = "/dev/shm" if os.path.isdir("/dev/shm") else \
+    tempfile.gettempdir()
+
+# function id -> specialized function, inherited by the forked workers
+SHARDED_FUNCTIONS = {}
+FUNCTION_IDS = itertools.count()
+
+# files of the shared arrays this process made, removed when it exits
+SEGMENTS = set()
+
+
+def remove_segment(path):
+    SEGMENTS.discard(path)
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+@atexit.register
+def remove_segments():
+    for path in list(SEGMENTS):
+        remove_segment(path)
+
+
+def shared_array(shape, dtype=np.float64):
+    fd, path = tempfile.mkstemp(prefix="ctree-", suffix=".shm",
+                                dir=SHARED_PATH)
+    os.close(fd)
+    SEGMENTS.add(path)
+    return np.memmap(path, dtype, 'w+', shape=shape)
+
+
+def is_shared(array):
+    return isinstance(array, np.memmap) and array.filename is not None and \
+        array.flags.c_contiguous and array.flags.writeable
+
+
+def get_offset(array):
+    # views of a memmap keep the offset of the one that mapped the file
+    base = array
+    while isinstance(base.base, np.ndarray):
+        base = base.base
+    return base.offset + array.ctypes.data - base.ctypes.data
+
+
+def attach(segment):
+    filename, dtype, offset, shape = segment
+    return np.memmap(filename, dtype, 'r+', offset=offset, shape=shape)
+
+
+def run_shard(task):
+    function_id, segments = task
+    shards = [attach(segment) if isinstance(segment, tuple) else segment
+              for segment in segments]
+    result = SHARDED_FUNCTIONS[function_id](*shards)
+    # the shards of the arguments are already in the shared file, only
+    # partial results travel back
+    for index, shard in enumerate(shards):
+        if result is shard:
+            return ArgumentResult(index)
+    return result
+
+
+class ArgumentResult(object):
+    def __init__(self, index):
+        self.index = index
+
+
+def get_axis(node):
+    for keyword in node.keywords:
+        if keyword.arg == 'axis':
+            return keyword.value
+    return None
+
+
+def is_row_independent(tree, args):
+    # whether each block of rows gives its part of the result on its own:
+    # scans and filters carry a position across the rows, and an operator
+    # along the first axis sees only a block of it
+    func_def = tree.body[0]
+    ndims = dict((param.id, arg.ndim) for param, arg
+                 in zip(func_def.args.args, args)
+                 if isinstance(arg, np.ndarray))
+    for node in ast.walk(func_def):
+        if not isinstance(node, ast.Call):
+            continue
+        name = getattr(node.func, "id", None)
+        if name in ('np_scan', 'np_filter'):
+            return False
+        if name not in ('np_map', 'np_reduce') or get_axis(node) is None:
+            continue
+        array = node.args[1] if len(node.args) > 1 else None
+        ndim = ndims.get(getattr(array, "id", None))
+        try:
+            axis = ast.literal_eval(get_axis(node))
+        except ValueError:
+            return False
+        if ndim is None or not isinstance(axis, int) or \
+                not -ndim <= axis < ndim:
+            return False
+        # reducing the only axis is a full reduction, which combine joins
+        if axis % ndim == 0 and not (name == 'np_reduce' and ndim == 1):
+            return False
+    return True
+
+
+class ShardedFunction(object):
+    # runs a specialized function on row blocks of its arrays in a pool of
+    # processes mapping them from shared memory, arrays that don't come from
+    # shared_array() are copied to and from one around each call. functions
+    # whose result depends on more than a block of rows run unsharded
+    def __init__(self, specialized, processes=None, combine=None):
+        self.specialized = specialized
+        self.processes = processes or multiprocessing.cpu_count()
+        self.combine = combine
+        self.function_id = next(FUNCTION_IDS)
+        self.pool = None
+        # argument dimensions -> whether the blocks can run apart
+        self.shardable = {}
+        SHARDED_FUNCTIONS[self.function_id] = specialized
+
+    def __call__(self, *args):
+        if not self.is_shardable(args):
+            return self.specialized(*args)
+        shared_args = [arg if not isinstance(arg, np.ndarray) or is_shared(arg)
+                       else self.to_shared(arg) for arg in args]
+        tasks = []
+        compiled = set()
+        for shards in self.get_shards(shared_args):
+            # the workers load the kernels built here rather than racing to
+            # build the same ones
+            self.compile(shards, compiled)
+            tasks.append((self.function_id, [
+                (shard.filename, shard.dtype.str, get_offset(shard),
+                 shard.shape) if isinstance(shard, np.memmap) else shard
+                for shard in shards]))
+        if self.pool is None:
+            # forked once the specialized function is registered
+            self.pool = multiprocessing.Pool(self.processes)
+        results = self.pool.map(run_shard, tasks)
+
+        for arg, shared_arg in zip(args, shared_args):
+            if shared_arg is not arg:
+                arg[...] = shared_arg
+                remove_segment(shared_arg.filename)
+        if all(isinstance(result, ArgumentResult) for result in results):
+            return args[results[0].index]
+        if self.combine is None:
+            raise Exception("%s returned partial results, combining them "
+                            "needs a combine function" %
+                            self.specialized.original_tree.body[0].name)
+        return reduce(self.combine, results)
+
+    def is_shardable(self, args):
+        key = tuple(getattr(arg, "ndim", None) for arg in args)
+        if key not in self.shardable:
+            self.shardable[key] = is_row_independent(
+                self.specialized.original_tree, args)
+        return self.shardable[key]
+
+    def to_shared(self, array):
+        shared = shared_array(array.shape, array.dtype)
+        shared[...] = array
+        return shared
+
+    def get_shards(self, args):
+        # arrays are split along their first axis, the ones that don't have
+        # the rows of the first array (broadcast operands) go whole
+        first = next(arg for arg in args if isinstance(arg, np.ndarray))
+        rows = first.shape[0] if first.ndim else 1
+        blocks = min(self.processes, rows)
+        bounds = [rows * block // blocks for block in range(blocks + 1)]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            yield [arg[start:stop] if isinstance(arg, np.ndarray) and
+                   arg.ndim == first.ndim and arg.ndim and
+                   arg.shape[0] == rows else arg
+                   for arg in args]
+
+    def compile(self, shards, compiled):
+        # what LazySpecializedFunction.__call__ does short of running it
+        specialized = self.specialized
+        program_config = specialized.get_program_config(shards, {})
+        dir_name = specialized.config_to_dirname(program_config)
+        if dir_name in compiled:
+            return
+        makedirs(dir_name)
+        specialized.finalize(
+            specialized.get_transform_result(program_config, dir_name),
+            program_config)
+        compiled.add(dir_name)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        SHARDED_FUNCTIONS.pop(self.function_id, None)
+
+
+if __name__ == '__main__':
+    import logging
+    from np_functional import BasicTranslator, np_map, np_reduce
+
+    logging.disable(logging.INFO)
+
+    def square(a):
+        return np_map(lambda x: x * x, a)
+
+    def total(a):
+        return np_reduce(lambda x, y: x + y, a)
+
+    test_array = shared_array((1 << 10, 1 << 10))
+    test_array[...] = np.arange(1 << 20).reshape(1 << 10, 1 << 10) % 7
+    c_square = ShardedFunction(BasicTranslator.from_function(square), 4)
+    c_total = ShardedFunction(BasicTranslator.from_function(total), 4,
+                              combine=lambda x, y: x + y)
+    c_square(test_array)
+    print c_total(test_array), total(np.asarray(test_array))
+    c_square.close()
+    c_total.close()
@@ -0,0 +1,80 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import ctree
+from cache_dirs import CACHE_ROOT, cache_dir
+
+log = logging.getLogger(__name__)
+
+# unlike the jit COMPILE_PATH this is the same for every process of a user,
+# so that they all find the builds of the others
+BUILD_PATH = os.path.join(CACHE_ROOT, "builds")
+
+
+def get_source(c_file):
+    # files coming from the on-disk cache have no body, their source is
+    # already there
+    c_src_file = os.path.join(c_file.path, c_file.get_filename())
+    if not c_file.body:
+        with open(c_src_file) as source:
+            return source.read()
+    source = c_file.codegen()
+    with open(c_src_file, 'w') as source_file:
+        source_file.write(source)
+    return source
+
+
+def get_compile_command(config_target, so_file, c_src_files):
+    return "%s -shared %s -o %s %s %s" % (
+        ctree.CONFIG.get(config_target, 'CC'),
+        ctree.CONFIG.get(config_target, 'CFLAGS'), so_file,
+        " ".join(c_src_files), ctree.CONFIG.get(config_target, 'LDFLAGS'))
+
+
+def build_shared_object(c_files):
+    # one build per distinct source and command, whichever process gets to
+    # it first builds it while the others wait on its lock and load the result
+    config_targets = set(c_file.config_target for c_file in c_files)
+    if len(config_targets) != 1:
+        raise Exception("files with different config targets can't be built "
+                        "together: %s" % sorted(config_targets))
+    config_target = config_targets.pop()
+    sources = [(c_file.get_filename(), get_source(c_file))
+               for c_file in c_files]
+
+    key = hashlib.sha1()
+    for filename, source in sources:
+        key.update(filename)
+        key.update(source)
+    key.update(get_compile_command(config_target, "", []))
+    so_file = os.path.join(cache_dir(BUILD_PATH),
+                           "%s.so" % key.hexdigest()[:20])
+    if os.path.exists(so_file):
+        ctree.STATS.log("shared build hit")
+        return so_file
+
+    with open(so_file[:-len(".so")] + ".lock", 'a') as lock:
+        # released when the lock file is closed
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(so_file):
+            ctree.STATS.log("shared build hit")
+            return so_file
+        ctree.STATS.log("shared build miss")
+        build_dir = tempfile.mkdtemp(prefix="build-", dir=BUILD_PATH)
+        try:
+            for filename, source in sources:
+                with open(os.path.join(build_dir, filename), 'w') as c_src:
+                    c_src.write(source)
+            compile_cmd = get_compile_command(
+                config_target, "kernel.so",
+                [filename for filename, _ in sources])
+            log.info("shared build compilation command: %s", compile_cmd)
+            subprocess.check_call(compile_cmd, shell=True, cwd=build_dir)
+            os.rename(os.path.join(build_dir, "kernel.so"), so_file)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+    return so_file
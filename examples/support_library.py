@@ -0,0 +1,94 @@
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import ctree
+from cache_dirs import CACHE_ROOT, cache_dir
+
+log = logging.getLogger(__name__)
+
+CONFIG_LOCK = threading.Lock()
+
+SUPPORT_PATH = os.path.join(CACHE_ROOT, "support")
+
+
+class SupportLibrary(object):
+    def __init__(self, name, sources, headers=(), config_target='c',
+                 cflags=""):
+        self.name = name
+        self.sources = [os.path.abspath(source) for source in sources]
+        self.headers = [os.path.abspath(header) for header in headers]
+        self.config_target = config_target
+        self.cflags = cflags
+
+    def get_compile_command(self, source, object_file):
+        include_dirs = sorted(set(os.path.dirname(path) for path in
+                                  self.sources + self.headers))
+        flags = [ctree.CONFIG.get(self.config_target, 'CFLAGS'), self.cflags]
+        flags.extend("-I%s" % include_dir for include_dir in include_dirs)
+        return "%s -c %s -o %s %s" % (
+            ctree.CONFIG.get(self.config_target, 'CC'),
+            " ".join(" ".join(flags).split()), object_file, source)
+
+    @property
+    def key(self):
+        # the sources, the headers they include and the compile commands
+        key = hashlib.sha1()
+        for path in self.sources + self.headers:
+            with open(path, 'rb') as source_file:
+                key.update(source_file.read())
+        for source in self.sources:
+            key.update(self.get_compile_command(source, ""))
+        return key.hexdigest()[:16]
+
+    @property
+    def archive_path(self):
+        # unlike the jit COMPILE_PATH this outlives the process
+        return os.path.join(SUPPORT_PATH, "lib%s-%s.a" % (self.name, self.key))
+
+    def build(self):
+        archive_path = self.archive_path
+        archive_dir = cache_dir(os.path.dirname(archive_path))
+        if os.path.exists(archive_path):
+            return archive_path
+
+        # concurrent builds of the same library each work in their own
+        # directory and the last rename wins with an identical archive
+        build_dir = tempfile.mkdtemp(prefix="%s-" % self.name, dir=archive_dir)
+        try:
+            object_files = []
+            for index, source in enumerate(self.sources):
+                object_file = os.path.join(build_dir, "%d.o" % index)
+                compile_cmd = self.get_compile_command(source, object_file)
+                log.info("support library compilation command: %s",
+                         compile_cmd)
+                subprocess.check_call(compile_cmd, shell=True)
+                object_files.append(object_file)
+            build_archive = os.path.join(build_dir, "lib%s.a" % self.name)
+            subprocess.check_call(["ar", "rcs", build_archive] + object_files)
+            os.rename(build_archive, archive_path)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        return archive_path
+
+
+def get_linked_config_target(libraries, config_target='c'):
+    # a config section per set of built libraries: it only ever gets the
+    # same values, and the base target is left alone for everyone else
+    archives = [library.build() for library in libraries]
+    section = "%s+%s" % (config_target, "+".join(
+        "%s-%s" % (library.name, library.key) for library in libraries))
+    with CONFIG_LOCK:
+        if not ctree.CONFIG.has_section(section):
+            ldflags = ctree.CONFIG.get(config_target, 'LDFLAGS')
+            ctree.CONFIG.add_section(section)
+            ctree.CONFIG.set(section, 'CC',
+                             ctree.CONFIG.get(config_target, 'CC'))
+            ctree.CONFIG.set(section, 'CFLAGS',
+                             ctree.CONFIG.get(config_target, 'CFLAGS'))
+            ctree.CONFIG.set(section, 'LDFLAGS',
+                             " ".join(archives + [ldflags]).strip())
+    return section
@@ -0,0 +1,75 @@
+import os
+from string import Template
+from textwrap import dedent
+from ctree.nodes import CtreeNode
+from ctree.templates.codegen import TemplateCodeGen
+from ctree.templates.dotgen import TemplateDotLabeller
+from ctree.templates.nodes import StringTemplate
+
+
+class TemplateCache(object):
+    def __init__(self):
+        self._templates = {}
+        self.hits = 0
+        self.misses = 0
+
+    def from_string(self, template_txt):
+        return self._get(('string', template_txt), lambda: template_txt)
+
+    def from_file(self, template_path):
+        template_path = os.path.abspath(template_path)
+        mtime = os.path.getmtime(template_path)
+
+        def read():
+            with open(template_path, "r") as template_file:
+                return template_file.read()
+
+        return self._get(('file', template_path, mtime), read)
+
+    def _get(self, key, read):
+        parsed = self._templates.get(key)
+        if parsed is None:
+            self.misses += 1
+            parsed = Template(dedent(read()))
+            self._templates[key] = parsed
+        else:
+            self.hits += 1
+        return parsed
+
+    def clear(self):
+        self._templates.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._templates)
+
+
+TEMPLATE_CACHE = TemplateCache()
+
+
+class CachedTemplate(StringTemplate):
+    # a StringTemplate on an already parsed template, what
+    # TemplateNode.__init__ does without dedenting and parsing the text again.
+    # It generates code like any other template
+    def __init__(self, template, child_dict=None):
+        self._template = template
+        self._children = dict(child_dict or {})
+        self._fields = self._children.keys()
+        CtreeNode.__init__(self)
+
+    # ctree's visitors dispatch on the class name
+    def codegen(self, indent=0):
+        return TemplateCodeGen(indent).visit_StringTemplate(self)
+
+    def label(self):
+        return TemplateDotLabeller().visit_StringTemplate(self)
+
+
+def cached_string_template(template_txt, child_dict=None):
+    return CachedTemplate(TEMPLATE_CACHE.from_string(template_txt),
+                          child_dict)
+
+
+def cached_file_template(template_path, child_dict=None):
+    return CachedTemplate(TEMPLATE_CACHE.from_file(template_path), child_dict)
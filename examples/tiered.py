@@ -0,0 +1,242 @@
+import ctypes
+from distutils.spawn import find_executable
+import logging
+import os
+import re
+import subprocess
+import threading
+import weakref
+import ctree
+from ctree.c.nodes import CFile
+from ctree.jit import ConcreteSpecializedFunction
+from ctree.nodes import Project
+
+from kernel_cache import SharedLibrary
+from type_inference import TypeInferringTranslator, describe_ctype, \
+    ctype_from_description
+
+log = logging.getLogger(__name__)
+
+TCC = find_executable("tcc")
+
+# guards adding the config targets of unpickled functions
+CONFIG_LOCK = threading.Lock()
+
+OPTIMIZATION_FLAGS = re.compile(r"(^|\s)-(O\S*|march=\S+)")
+
+# tier -> (suffix of the shared object, flags replacing the -O/-march ones)
+TIERS = {
+    0: ("tier0", "-O0"),
+    1: ("tier1", "-O3 -march=native"),
+}
+
+
+def get_compile_command(c_file, so_file, tier):
+    config_target = c_file.config_target
+    cflags = " ".join(OPTIMIZATION_FLAGS.sub(
+        " ", ctree.CONFIG.get(config_target, 'CFLAGS')).split())
+    ldflags = ctree.CONFIG.get(config_target, 'LDFLAGS')
+    # tcc compiles much faster than gcc -O0 but knows nothing of OpenMP
+    if tier == 0 and TCC is not None and "-fopenmp" not in cflags:
+        return "%s -shared -o %s %s %s" % (TCC, so_file,
+                                           c_file.get_filename(), ldflags)
+    return "%s -shared %s %s -o %s %s %s" % (
+        ctree.CONFIG.get(config_target, 'CC'), cflags, TIERS[tier][1],
+        so_file, c_file.get_filename(), ldflags)
+
+
+def compile_tier(c_files, tier):
+    so_file = None
+    for c_file in c_files:
+        c_src_file = os.path.join(c_file.path, c_file.get_filename())
+        # files coming from the on-disk cache have no body, their source is
+        # already there
+        if c_file.body:
+            with open(c_src_file, 'w') as source:
+                source.write(c_file.codegen())
+        so_file = "%s.%s.so" % (c_file.name, TIERS[tier][0])
+        if not is_fresh(os.path.join(c_file.path, so_file), c_src_file):
+            compile_cmd = get_compile_command(c_file, so_file, tier)
+            log.info("tier %d compilation command: %s", tier, compile_cmd)
+            subprocess.check_call(compile_cmd, shell=True, cwd=c_file.path)
+        so_file = os.path.join(c_file.path, so_file)
+    return so_file
+
+
+def is_fresh(so_file, c_src_file):
+    return os.path.exists(so_file) and \
+        os.path.getmtime(so_file) >= os.path.getmtime(c_src_file)
+
+
+def load_function(so_file, entry_name, entry_typesig):
+    # the library is closed once the function is gone
+    function = SharedLibrary(so_file)[entry_name]
+    function.argtypes = entry_typesig._argtypes_
+    function.restype = entry_typesig._restype_
+    return function
+
+
+class TieredFunction(ConcreteSpecializedFunction):
+    def __init__(self, entry_name, project_node, entry_typesig,
+                 hot_threshold=100):
+        self.entry_name = entry_name
+        self.entry_typesig = entry_typesig
+        self.hot_threshold = hot_threshold
+        self.c_files = [f for f in project_node.files if isinstance(f, CFile)]
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._rebuild = None
+        self.unloaded = False
+
+        self.tier = 0
+        c_src_files = [os.path.join(f.path, f.get_filename())
+                       for f in self.c_files]
+        # kernels that got hot in an earlier run start at the top tier
+        if all(not f.body and is_fresh(
+                os.path.join(f.path, "%s.%s.so" % (f.name, TIERS[1][0])), src)
+               for f, src in zip(self.c_files, c_src_files)):
+            self.tier = 1
+        self.load(compile_tier(self.c_files, self.tier))
+
+    def load(self, so_file):
+        self.so_file = so_file
+        self.nbytes = os.path.getsize(so_file)
+        self._c_function = load_function(so_file, self.entry_name,
+                                         self.entry_typesig)
+
+    def __getstate__(self):
+        # like a BasicFunction, a reference to the built library and the
+        # sources it is rebuilt from once hot, which stay on this machine.
+        # The compiler options go along, their config target may only have
+        # been added to this process's configuration
+        return {'entry_name': self.entry_name,
+                'argtypes': [describe_ctype(argtype) for argtype in
+                             self.entry_typesig._argtypes_],
+                'restype': describe_ctype(self.entry_typesig._restype_),
+                'hot_threshold': self.hot_threshold,
+                'c_files': [(f.name, f.config_target, f.path,
+                             [(option, ctree.CONFIG.get(f.config_target,
+                                                        option))
+                              for option in ('CC', 'CFLAGS', 'LDFLAGS')])
+                            for f in self.c_files],
+                'tier': self.tier, 'so_file': self.so_file}
+
+    def __setstate__(self, state):
+        if not os.path.exists(state['so_file']):
+            raise Exception("%s was built by another process and is gone, "
+                            "the function has to be specialized again" %
+                            state['so_file'])
+        self.entry_name = state['entry_name']
+        self.entry_typesig = ctypes.CFUNCTYPE(
+            ctype_from_description(state['restype']),
+            *[ctype_from_description(description)
+              for description in state['argtypes']])
+        self.hot_threshold = state['hot_threshold']
+        # without a body, the sources already on disk are compiled
+        self.c_files = []
+        for name, config_target, path, options in state['c_files']:
+            with CONFIG_LOCK:
+                if not ctree.CONFIG.has_section(config_target):
+                    ctree.CONFIG.add_section(config_target)
+                    for option, value in options:
+                        ctree.CONFIG.set(config_target, option, value)
+            self.c_files.append(CFile(name, [], config_target, path))
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._rebuild = None
+        self.unloaded = False
+        self.tier = state['tier']
+        self.load(state['so_file'])
+
+    def unload(self):
+        # a rebuild still running finds the function unloaded and drops what
+        # it built, the library closes once no caller holds the C function
+        with self._lock:
+            self.unloaded = True
+            del self._c_function
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls >= self.hot_threshold and self.tier == 0 and \
+                self._rebuild is None:
+            self._start_rebuild()
+        return self._c_function(*args, **kwargs)
+
+    def _start_rebuild(self):
+        with self._lock:
+            if self._rebuild is not None:
+                return
+            self._rebuild = threading.Thread(target=self._promote)
+            self._rebuild.daemon = True
+            self._rebuild.start()
+
+    def _promote(self):
+        try:
+            so_file = compile_tier(self.c_files, 1)
+            function = load_function(so_file, self.entry_name,
+                                     self.entry_typesig)
+        except (subprocess.CalledProcessError, OSError) as error:
+            log.warning("tier 1 rebuild of %s failed, staying at tier 0: %s",
+                        self.entry_name, error)
+            return
+        with self._lock:
+            if self.unloaded:
+                return
+            # a single reference assignment, callers see either build in
+            # full
+            self.so_file = so_file
+            self._c_function = function
+            self.tier = 1
+        log.info("%s promoted to tier 1 after %d calls", self.entry_name,
+                 self.calls)
+
+    def wait(self):
+        if self._rebuild is not None:
+            self._rebuild.join()
+
+
+class TieredTranslator(TypeInferringTranslator):
+    hot_threshold = 100
+
+    def __init__(self, *args, **kwargs):
+        super(TieredTranslator, self).__init__(*args, **kwargs)
+        # the call counts have to outlive a single call, so the concrete
+        # function is kept here even when ctree's jit cache is off. With the
+        # dispatch table of a BasicTranslator, the table keeps them and
+        # evicts them, and they're only looked up here
+        if hasattr(self, 'dispatch'):
+            self.tiered_functions = weakref.WeakValueDictionary()
+        else:
+            self.tiered_functions = {}
+
+    def finalize(self, transform_result, program_config):
+        dir_name = self.config_to_dirname(program_config)
+        function = self.tiered_functions.get(dir_name)
+        # evicted from a dispatch table and unloaded, it starts over
+        if function is None or function.unloaded:
+            function = TieredFunction(
+                self.entry_name, Project(transform_result),
+                self.get_entry_type(program_config), self.hot_threshold)
+            self.tiered_functions[dir_name] = function
+        return function
+
+
+if __name__ == '__main__':
+    import time
+    import numpy as np
+    from np_functional import BasicTranslator, sum_array
+
+    class TieredSumTranslator(TieredTranslator, BasicTranslator):
+        hot_threshold = 20
+
+    c_sum_array = TieredSumTranslator.from_function(sum_array)
+    test_array = np.arange(1 << 20, dtype=np.float64)
+    for call in range(60):
+        start = time.time()
+        result = c_sum_array(test_array.copy())
+        function = c_sum_array.tiered_functions.values()[0]
+        if call % 10 == 0 or call == 59:
+            print "call %d: tier %d, %.6fs" % (call, function.tier,
+                                                time.time() - start)
+    function.wait()
+    print result, sum_array(test_array.copy())
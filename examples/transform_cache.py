@@ -0,0 +1,117 @@
+import ast
+import hashlib
+import inspect
+import json
+import logging
+import os
+import tempfile
+import ctree
+from ctree.c.nodes import MultiNode
+from cache_dirs import CACHE_ROOT, cache_dir
+
+log = logging.getLogger(__name__)
+
+# shared by the processes of a user, like the shared builds
+CACHE_PATH = os.path.join(CACHE_ROOT, "transforms")
+
+# the only classes an entry can build: the Python tree's nodes and the node
+# from_function wraps them in. entries are json rather than pickles so that
+# loading one never runs code
+NODE_TYPES = dict((name, value) for name, value in vars(ast).items()
+                  if isinstance(value, type) and issubclass(value, ast.AST))
+NODE_TYPES['MultiNode'] = MultiNode
+
+# class -> hash of the modules its specializer code comes from
+CODE_HASHES = {}
+
+
+def code_hash(cls):
+    # the generated code depends on the transformers, the helpers they call
+    # and ctree's code generation as much as on the translator, so every
+    # module the translator's classes are defined in and every module it
+    # declares goes into the key
+    if cls not in CODE_HASHES:
+        code = hashlib.sha1()
+        try:
+            modules = [inspect.getmodule(klass) for klass in cls.mro()
+                       if klass.__module__ != '__builtin__']
+            modules += getattr(cls, 'get_code_modules', list)()
+            for filename in sorted(set(inspect.getsourcefile(module)
+                                       for module in modules)):
+                with open(filename) as source:
+                    code.update(source.read())
+            CODE_HASHES[cls] = code.hexdigest()
+        except (IOError, TypeError):
+            # defined where its source can't be found, never cached
+            CODE_HASHES[cls] = None
+    return CODE_HASHES[cls]
+
+
+def cache_key(*parts):
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def to_json(value):
+    # json turns every string into unicode, the Python 2 unicode ones are
+    # marked so that the others come back as str
+    if isinstance(value, ast.AST):
+        fields = dict((name, to_json(getattr(value, name)))
+                      for name in tuple(value._fields) + value._attributes
+                      if hasattr(value, name))
+        fields['_type'] = type(value).__name__
+        return fields
+    if isinstance(value, unicode):
+        return {'_type': 'unicode', 'value': value}
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    if isinstance(value, dict):
+        return dict((name, to_json(item)) for name, item in value.items())
+    return value
+
+
+def from_json(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [from_json(item) for item in value]
+    if isinstance(value, dict):
+        if value.get('_type') == 'unicode':
+            return value['value']
+        fields = dict((str(name), from_json(item))
+                      for name, item in value.items())
+        if '_type' not in fields:
+            return fields
+        return NODE_TYPES[fields.pop('_type')](**fields)
+    return value
+
+
+def load(kind, key):
+    path = os.path.join(cache_dir(os.path.join(CACHE_PATH, kind)), key)
+    if not os.path.exists(path):
+        ctree.STATS.log("%s cache miss" % kind)
+        return None
+    try:
+        with open(path) as cached:
+            value = from_json(json.load(cached))
+    except Exception:
+        # written by another version, it's overwritten after the miss
+        log.warning("unreadable %s cache entry %s", kind, path)
+        ctree.STATS.log("%s cache miss" % kind)
+        return None
+    ctree.STATS.log("%s cache hit" % kind)
+    return value
+
+
+def store(kind, key, value):
+    directory = cache_dir(os.path.join(CACHE_PATH, kind))
+    try:
+        encoded = json.dumps(to_json(value))
+    except (TypeError, ValueError):
+        # a constant json can't hold, the entry is built again every time
+        log.warning("%s cache entry %s can't be stored", kind, key)
+        return
+    # renamed into place, a process loading it never sees half of it
+    fd, temporary = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as cached:
+        cached.write(encoded)
+    os.rename(temporary, os.path.join(directory, key))
@@ -0,0 +1,408 @@
+import ctypes
+import json
+import os
+import tempfile
+from ctree.c.nodes import FunctionDecl, FunctionCall, SymbolRef, Constant, \
+    BinaryOp, UnaryOp, TernaryOp, AugAssign, Cast, Op
+from ctree.jit import LazySpecializedFunction
+from ctree.types import get_c_type_from_numpy_dtype
+from ctree.util import flatten
+from ctree.visitors import NodeTransformer
+import numpy as np
+
+from lambda_optimizer import SharedExpression
+
+COMPARISON_OPS = (Op.Gt, Op.Lt, Op.GtE, Op.LtE, Op.Eq, Op.NotEq, Op.And,
+                  Op.Or)
+
+FLOAT_TYPES = (ctypes.c_float, ctypes.c_double, ctypes.c_longdouble)
+
+UNSIGNED_TYPES = (ctypes.c_ubyte, ctypes.c_ushort, ctypes.c_uint,
+                  ctypes.c_ulong, ctypes.c_ulonglong)
+
+
+# saved next to the generated sources, the signature of their entry point
+ENTRY_TYPE_FILENAME = "entry_type.json"
+
+
+def describe_ctype(ctype):
+    # as json: ndpointer types by the arguments that create them again, the
+    # others by name
+    if hasattr(ctype, '_dtype_'):
+        return ['ndpointer', ctype._dtype_.str, ctype._ndim_, ctype._shape_,
+                ctype._flags_]
+    if ctype is None:
+        return None
+    if CTYPES.get(ctype.__name__) is not ctype:
+        raise TypeError("%s can't be described" % ctype.__name__)
+    return ctype.__name__
+
+
+def ctype_from_description(description):
+    if isinstance(description, list):
+        _, dtype, ndim, shape, flags = description
+        return np.ctypeslib.ndpointer(dtype, ndim, shape and tuple(shape),
+                                      flags)
+    if description is None:
+        return None
+    return CTYPES[description]
+
+
+class IntLiteral(ctypes.c_long):
+    pass
+
+
+class FloatLiteral(ctypes.c_double):
+    pass
+
+
+# the types a description can name
+CTYPES = dict((value.__name__, value) for value in vars(ctypes).values()
+              if isinstance(value, type) and
+              issubclass(value, ctypes._SimpleCData) and
+              value.__module__ == 'ctypes')
+CTYPES.update(IntLiteral=IntLiteral, FloatLiteral=FloatLiteral)
+
+
+def to_ctype(sym_type):
+    # the numpy scalar types some transformers use map onto plain ctypes
+    if isinstance(sym_type, np.generic):
+        return get_c_type_from_numpy_dtype(np.dtype(type(sym_type)))()
+    return sym_type
+
+
+def element_type(sym_type):
+    if isinstance(sym_type, np.ctypeslib._ndptr):
+        return get_c_type_from_numpy_dtype(sym_type._dtype_)()
+    if isinstance(sym_type, ctypes._Pointer):
+        return sym_type._type_()
+    return None
+
+
+def declared_type(sym_type):
+    # literals only decide a type when nothing else does
+    if isinstance(sym_type, FloatLiteral):
+        return ctypes.c_double()
+    if isinstance(sym_type, IntLiteral):
+        return ctypes.c_long()
+    return sym_type
+
+
+def rank(sym_type):
+    if isinstance(sym_type, (np.ctypeslib._ndptr, ctypes._Pointer)):
+        return 2, 0, False
+    return (int(isinstance(sym_type, FLOAT_TYPES)), ctypes.sizeof(sym_type),
+            isinstance(sym_type, UNSIGNED_TYPES))
+
+
+def join(*sym_types):
+    sym_types = [to_ctype(t) for t in sym_types if t is not None]
+    if not sym_types:
+        return None
+    literals = [t for t in sym_types
+                if isinstance(t, (IntLiteral, FloatLiteral))]
+    typed = [t for t in sym_types
+             if not isinstance(t, (IntLiteral, FloatLiteral))]
+    if not typed:
+        return max(literals, key=rank)
+    result = max(typed, key=rank)
+    if not isinstance(result, FLOAT_TYPES) and \
+            any(isinstance(t, FloatLiteral) for t in literals):
+        return ctypes.c_double()
+    return result
+
+
+class TypeInference(NodeTransformer):
+    def __init__(self, entry_types, entry_name="apply"):
+        self.entry_types = entry_types
+        self.entry_name = entry_name
+        self.function_types = {}
+        self.macros = {}
+        self.macro_signatures = {}
+        self.environments = [{}]
+        self.return_types = []
+
+    def lookup(self, name):
+        for environment in reversed(self.environments):
+            if name in environment:
+                return environment[name]
+        return None
+
+    def declare(self, name, sym_type):
+        self.environments[-1][name] = sym_type
+
+    def visit_CFile(self, node):
+        for child in flatten(node.body):
+            self.visit(child)
+        # a macro is only narrowed when all of its uses agree on the types
+        for name, signatures in self.macro_signatures.items():
+            if len(signatures) == 1:
+                self.visit_macro(self.macros[name],
+                                 list(signatures.values())[0])
+        return node
+
+    def visit_CppDefine(self, node):
+        self.macros[node.name] = node
+        return node
+
+    def visit_macro(self, macro, arg_types):
+        self.environments.append(dict(zip(
+            [param.name for param in macro.params], arg_types)))
+        macro.body = self.visit(macro.body)
+        self.environments.pop()
+
+    def visit_FunctionDecl(self, node):
+        if node.name == self.entry_name:
+            for param, sym_type in zip(node.params, self.entry_types):
+                param.type = sym_type
+        node.return_type = to_ctype(node.return_type)
+        self.function_types[node.name] = node.return_type
+
+        self.environments.append({})
+        for param in node.params:
+            param.type = to_ctype(param.type)
+            self.declare(param.name, param.type)
+        outer_return_types, self.return_types = self.return_types, []
+        node.defn = self.visit_body(node.defn)
+        if node.return_type is None and self.return_types:
+            node.return_type = declared_type(join(*self.return_types))
+            self.function_types[node.name] = node.return_type
+        self.return_types = outer_return_types
+        self.environments.pop()
+        return node
+
+    def visit_body(self, body, scoped=False):
+        if scoped:
+            self.environments.append({})
+        body = [self.visit(statement) for statement in body]
+        if scoped:
+            self.environments.pop()
+        return body
+
+    def visit_If(self, node):
+        node.cond = self.visit(node.cond)
+        node.then = self.visit_body(node.then, scoped=True)
+        if node.elze is not None:
+            node.elze = self.visit_body(node.elze, scoped=True)
+        return node
+
+    def visit_For(self, node):
+        self.environments.append({})
+        node.init = self.visit(node.init)
+        node.test = self.visit(node.test)
+        node.incr = self.visit(node.incr)
+        node.body = self.visit_body(node.body, scoped=True)
+        self.environments.pop()
+        return node
+
+    def visit_While(self, node):
+        node.cond = self.visit(node.cond)
+        node.body = self.visit_body(node.body, scoped=True)
+        return node
+
+    def visit_Return(self, node):
+        if node.value is not None:
+            node.value = self.visit(node.value)
+            self.return_types.append(self.type_of(node.value))
+        return node
+
+    def visit_BinaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, Op.Assign) and \
+                isinstance(node.left, SymbolRef):
+            if node.left.type is not None:
+                node.left.type = to_ctype(node.left.type)
+                self.declare(node.left.name, node.left.type)
+            elif self.lookup(node.left.name) is None:
+                # a new node declares it, the untyped one may be shared by
+                # every other use of the name
+                node.left = SymbolRef(node.left.name,
+                                      declared_type(self.type_of(node.right)))
+                self.declare(node.left.name, node.left.type)
+        elif not isinstance(node.op, (Op.Assign, Op.ArrayRef)):
+            self.narrow(node, join(self.type_of(node.left),
+                                   self.type_of(node.right)))
+        return node
+
+    def visit_SharedExpression(self, node):
+        self.environments.append({})
+        for index, value in enumerate(node.values):
+            node.values[index] = self.visit(value)
+            self.declare(node.names[index], self.type_of(node.values[index]))
+        node.result = self.visit(node.result)
+        self.environments.pop()
+        return node
+
+    def visit_FunctionCall(self, node):
+        self.generic_visit(node)
+        # records the argument types of macro calls even where the result
+        # is not needed for a declaration
+        self.call_type(node)
+        return node
+
+    def narrow(self, node, sym_type):
+        # keep single precision arithmetic from being promoted to double
+        if not isinstance(sym_type, ctypes.c_float):
+            return
+        for field in ('left', 'right'):
+            child = getattr(node, field)
+            if isinstance(child, Constant) and \
+                    isinstance(child.value, float):
+                setattr(node, field, Cast(ctypes.c_float(), child))
+
+    def type_of(self, node):
+        if isinstance(node, Constant):
+            if isinstance(node.value, float):
+                return FloatLiteral()
+            return IntLiteral()
+        if isinstance(node, SymbolRef):
+            return self.lookup(node.name)
+        if isinstance(node, Cast):
+            return to_ctype(node.type)
+        if isinstance(node, FunctionCall):
+            return self.call_type(node)
+        if isinstance(node, UnaryOp):
+            if isinstance(node.op, Op.Not):
+                return ctypes.c_int()
+            return self.type_of(node.arg)
+        if isinstance(node, AugAssign):
+            return self.type_of(node.target)
+        if isinstance(node, TernaryOp):
+            return join(self.type_of(node.then), self.type_of(node.elze))
+        if isinstance(node, SharedExpression):
+            self.environments.append({})
+            for name, value in zip(node.names, node.values):
+                self.declare(name, self.type_of(value))
+            sym_type = self.type_of(node.result)
+            self.environments.pop()
+            return sym_type
+        if isinstance(node, BinaryOp):
+            if isinstance(node.op, Op.ArrayRef):
+                return element_type(self.type_of(node.left))
+            if isinstance(node.op, COMPARISON_OPS):
+                return ctypes.c_int()
+            if isinstance(node.op, Op.Assign):
+                return self.type_of(node.left)
+            return join(self.type_of(node.left), self.type_of(node.right))
+        return None
+
+    def call_type(self, node):
+        name = getattr(node.func, 'name', None)
+        if name in self.macros:
+            arg_types = tuple(declared_type(self.type_of(arg))
+                              for arg in node.args)
+            self.macro_signatures.setdefault(name, {})[
+                tuple(type(t) for t in arg_types)] = arg_types
+            macro = self.macros[name]
+            self.environments.append(dict(zip(
+                [param.name for param in macro.params], arg_types)))
+            sym_type = self.type_of(macro.body)
+            self.environments.pop()
+            return sym_type
+        return self.function_types.get(name)
+
+    def get_entry_type(self, c_file):
+        entry = c_file.find(FunctionDecl, name=self.entry_name)
+        return_type = None
+        if entry.return_type is not None:
+            return_type = type(entry.return_type)
+        return ctypes.CFUNCTYPE(return_type,
+                                *[type(param.type) for param in entry.params])
+
+
+class TypeInferringTranslator(LazySpecializedFunction):
+    entry_name = "apply"
+
+    def __init__(self, *args, **kwargs):
+        super(TypeInferringTranslator, self).__init__(*args, **kwargs)
+        # specialization directory -> signature of its entry point
+        self.entry_types = {}
+
+    def args_to_types(self, args_subconfig):
+        return [args_subconfig['arg_type']()]
+
+    def infer_types(self, c_file, program_config):
+        inference = TypeInference(
+            self.args_to_types(program_config.args_subconfig),
+            self.entry_name)
+        inference.visit(c_file)
+        self.set_entry_type(self.config_to_dirname(program_config),
+                            inference.get_entry_type(c_file))
+        return c_file
+
+    def set_entry_type(self, dir_name, entry_type):
+        self.entry_types[dir_name] = entry_type
+        if not os.path.isdir(dir_name):
+            return
+        # renamed into place, a process hitting the cache never reads half
+        # of it
+        fd, temporary = tempfile.mkstemp(dir=dir_name)
+        with os.fdopen(fd, 'w') as entry_file:
+            json.dump([describe_ctype(entry_type._restype_),
+                       [describe_ctype(argtype)
+                        for argtype in entry_type._argtypes_]], entry_file)
+        os.rename(temporary, os.path.join(dir_name, ENTRY_TYPE_FILENAME))
+
+    def load_entry_type(self, dir_name):
+        try:
+            with open(os.path.join(dir_name, ENTRY_TYPE_FILENAME)) as \
+                    entry_file:
+                restype, argtypes = json.load(entry_file)
+        except (IOError, ValueError):
+            return None
+        return ctypes.CFUNCTYPE(ctype_from_description(restype),
+                                *[ctype_from_description(description)
+                                  for description in argtypes])
+
+    def get_entry_type(self, program_config):
+        dir_name = self.config_to_dirname(program_config)
+        if dir_name not in self.entry_types:
+            # the code came from the on-disk cache, so the transform that
+            # would have inferred the signature never ran in this process.
+            # It saved the signature next to the code
+            entry_type = self.load_entry_type(dir_name)
+            if entry_type is None:
+                # cached before signatures were saved
+                self.run_transform(program_config)
+            else:
+                self.entry_types[dir_name] = entry_type
+        return self.entry_types[dir_name]
+
+
+if __name__ == '__main__':
+    from ctree.c.nodes import CFile
+    from ctree.jit import ConcreteSpecializedFunction
+    from ctree.nodes import Project
+    from ctree.transformations import PyBasicConversions
+    from ctree.types import get_ctype
+
+    def fib(n):
+        if n < 2:
+            return n
+        else:
+            return fib(n - 1) + fib(n - 2)
+
+    class FibTranslator(TypeInferringTranslator):
+        def args_to_subconfig(self, args):
+            return {'arg_type': type(get_ctype(args[0]))}
+
+        def transform(self, tree, program_config):
+            tree = PyBasicConversions().visit(tree)
+            return [self.infer_types(CFile("generated", [tree]),
+                                     program_config)]
+
+        def finalize(self, transform_result, program_config):
+            return FibFunction(Project(transform_result),
+                               self.get_entry_type(program_config))
+
+    class FibFunction(ConcreteSpecializedFunction):
+        def __init__(self, project_node, entry_typesig):
+            self._c_function = self._compile("apply", project_node,
+                                             entry_typesig)
+
+        def __call__(self, *args, **kwargs):
+            return self._c_function(*args, **kwargs)
+
+    c_fib = FibTranslator.from_function(fib)
+    print c_fib(10), fib(10)
+    print c_fib(4.5), fib(4.5)